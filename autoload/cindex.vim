@@ -9,6 +9,7 @@ function! cindex#Enable()
 
     call s:SetupKeyMappings()
     call s:SetupCommands()
+    call s:SetupAutoCommands()
 
     " Automatically start server and index current working directory
     if g:cindex_autostart
@@ -17,34 +18,145 @@ function! cindex#Enable()
     endif
 endfunction
 
-" Starts vim.cindex server and retrieve assigned port
+" Connects to the daemon serving the current project, starting it if needed,
+" or starts a server within Vim and retrieve assigned port
 function! cindex#StartServer()
 python << endpython
 import vim
-port = cindexer.StartServer()
-vim.command("let s:cindex_port = {0}".format(port))
+from cindex import daemon
+from cindex.client import Client
+from cindex.setup import SetupCIndex, StartDaemon
+cindex_socket = None
+if cindexer is None:
+    cindex_root = daemon.project_root(os.getcwd())
+    cindex_socket = StartDaemon(cindex_root, jobs, cache_dir, include, exclude,
+                                debug_server)
+if cindex_socket:
+    cindexclient = Client(path=cindex_socket, attach=True)
+    vim.command("let s:cindex_root = '{0}'".format(cindex_root.replace("'", "''")))
+    vim.command("let s:cindex_address = '--socket ' . shellescape('{0}')"
+                .format(cindex_socket.replace("'", "''")))
+else:
+    if cindexer is None:
+        # No daemon for this project, fall back to a server within Vim
+        cindexer = SetupCIndex(debug_server, jobs, cache_dir, include, exclude)
+    port = cindexer.StartServer()
+    cindexclient = Client(port)
+    vim.command("let s:cindex_address = '--port {0}'".format(port))
 endpython
 endfunction
 
+" Returns the lines answered by the server, through the connection kept open
+" by the python client or through search.py if that one is not available
+function! cindex#Query(msg)
+  let lines = pyeval("cindexclient.Command(vim.eval('a:msg'))")
+  if type(lines) == type([])
+    return lines
+  endif
+  return split(s:SystemMessage(a:msg), '\v\n')
+endfunction
+
 function! cindex#SendMessage(msg)
-  "echom "system " . s:indexer_command . " --port " . s:cindex_port ." " . a:msg
-  return system(s:indexer_command . " --port " . s:cindex_port . " " . a:msg)
+  return join(cindex#Query(a:msg), "\n")
+endfunction
+
+function! s:SystemMessage(msg)
+  "echom "system " . s:indexer_command . " " . s:cindex_address ." " . a:msg
+  return system(s:indexer_command . " " . s:cindex_address . " " . a:msg)
 endfunction
 
-" Stops vim.cindex server
+" Stops vim.cindex server, only lets go of a daemon shared with other Vim
+" instances, it exits once none of them uses it
 function! cindex#StopServer()
-  call system(s:indexer_command . " --port " . s:cindex_port . " QUIT ")
+  if exists('s:cindex_root')
+    python cindexclient.Close()
+    unlet s:cindex_root s:cindex_address
+    return
+  endif
+  call cindex#SendMessage("QUIT")
 endfunction
 
-" Reindex files within current directory
+" Reindex files within current directory, or the project served by the
+" daemon, the ones open in Vim first
 function! cindex#Reindex()
-    let curDir = getcwd()
-    call cindex#SendMessage("INDEX " . curDir)
+    let curDir = exists('s:cindex_root') ? s:cindex_root : getcwd()
+    let priority = [expand('%:p')]
+    for buf in getbufinfo({'buflisted': 1})
+      if !empty(buf.name) && buf.bufnr != bufnr('%')
+        call add(priority, fnamemodify(buf.name, ':p'))
+      endif
+    endfor
+    let replies = cindex#Batch([{'cmd': 'INDEX', 'arg': curDir,
+                               \ 'priority': priority}])
+    if type(replies) != type([])
+      call cindex#SendMessage("INDEX " . curDir)
+    endif
+endfunction
+
+" Tells how far the indexing in progress is, results may be partial until
+" it is done
+function! cindex#Progress()
+  let replies = cindex#Batch([{'cmd': 'PROGRESS'}])
+  if type(replies) == type([]) && !empty(replies[0])
+    let progress = replies[0][0]
+    echo printf("cindex: indexed %d/%d file(s)", progress.done, progress.total)
+  else
+    echo "cindex: not indexing"
+  endif
+endfunction
+
+" Sends a list of {'cmd': ..., 'arg': ...} queries in a single round trip,
+" returns the list of results of each query or 0 if the server is unreachable
+function! cindex#Batch(queries)
+  let replies = pyeval("cindexclient.Batch(vim.eval('a:queries'))")
+  if type(replies) == type([])
+    return replies
+  endif
+  return 0
+endfunction
+
+" Index the content of the current buffer without having to write it
+function! cindex#IndexBuffer()
+  let content = join(getline(1, '$'), "\n") . "\n"
+  let queries = [{'cmd': 'BUFFER', 'arg': expand('%:p'), 'content': content}]
+  if !has('timers')
+    call cindex#Batch(queries)
+    return
+  endif
+  " Do not wait for the server, it may be busy indexing a directory
+  let request = pyeval("cindexclient.SubmitBatch(vim.eval('l:queries'))")
+  call timer_start(100, function('cindex#PollBuffer', [request]), {'repeat': -1})
+endfunction
+
+function! cindex#PollBuffer(request, timer)
+  if pyeval("cindexclient.Poll(" . a:request . ")").done
+    call timer_stop(a:timer)
+  endif
 endfunction
 
 function! cindex#JumpToImplementation()
   let wordUnderCursor = expand("<cword>")
   "silent !clear
+  " Ask for the declaration as well so types and functions without an
+  " implementation can be reached in the same round trip
+  let replies = cindex#Batch([{'cmd': 'IMPL', 'arg': wordUnderCursor},
+                            \ {'cmd': 'DECL', 'arg': wordUnderCursor},
+                            \ {'cmd': 'PROGRESS'}])
+  if type(replies) == type([])
+    for results in replies[:1]
+      if !empty(results)
+        call s:JumpTo(results[0].file, results[0].line, results[0].column)
+        return
+      endif
+    endfor
+    if !empty(replies[2])
+      " Might not have been reached yet
+      echo printf("cindex: %s not found, indexed %d/%d file(s)", wordUnderCursor,
+            \ replies[2][0].done, replies[2][0].total)
+    endif
+    return
+  endif
+
   let location = cindex#SendMessage("IMPL " . wordUnderCursor)
   let names =  matchlist( location, '\(.\{-1,}\):\%(\(\d\+\)\%(:\(\d*\):\?\)\?\)\?')
   if empty(names)
@@ -54,15 +166,18 @@ function! cindex#JumpToImplementation()
   let file_name = names[1]
   let line_num  = names[2] == ''? '0' : names[2]
   let  col_num  = names[3] == ''? '0' : names[3]
+  call s:JumpTo(file_name, line_num, col_num)
+endfunction
 
-  if filereadable(file_name)
+function! s:JumpTo(file_name, line_num, col_num)
+  if filereadable(a:file_name)
     let l:bufn = bufnr("%")
     "exec ":bwipeout " l:bufn
 
-    exec "keepalt edit " . file_name
-    exec ":" . line_num
-    exec "normal! " . col_num . '|'
-    if foldlevel(line_num) > 0
+    exec "keepalt edit " . a:file_name
+    exec ":" . a:line_num
+    exec "normal! " . a:col_num . '|'
+    if foldlevel(a:line_num) > 0
       exec "normal! zv"
     endif
     exec "normal! zz"
@@ -70,18 +185,144 @@ function! cindex#JumpToImplementation()
 endfunction
 
 function! cindex#Calls()
-  let wordUnderCursor = expand("<cword>")
-  let calls = cindex#SendMessage("CALLS " . wordUnderCursor)
+  call s:RequestCalls(expand("<cword>"), 0)
+endfunction
+
+" Lists the next page of the calls last listed, after the previous ones
+function! cindex#More()
+  if !exists('s:calls_next')
+    echo "cindex: no more calls"
+    return
+  endif
+  call s:RequestCalls(s:calls_word, s:calls_next)
+endfunction
+
+function! s:CallsCommand(word, offset)
+  if g:cindex_page_size <= 0
+    return "CALLS " . a:word
+  endif
+  return "CALLS " . a:word . " LIMIT " . g:cindex_page_size . " OFFSET " . a:offset
+endfunction
 
+function! s:RequestCalls(word, offset)
+  let s:calls_word = a:word
+  let s:calls_offset = a:offset
+  if exists('s:calls_next')
+    unlet s:calls_next
+  endif
+  let l:command = s:CallsCommand(a:word, a:offset)
+  if !has('timers')
+    call s:ShowCallsPage(cindex#Query(l:command))
+    return
+  endif
+
+  " Do not block while the server looks up calls, poll for the answer
+  if exists('s:calls_timer')
+    call timer_stop(s:calls_timer)
+    unlet s:calls_timer
+    execute "python cindexclient.Cancel(" . s:calls_request . ")"
+  endif
+  let s:calls_request = pyeval("cindexclient.Submit(vim.eval('l:command'))")
+  let s:calls_timer = timer_start(10, 'cindex#PollCalls', {'repeat': -1})
+endfunction
+
+function! cindex#PollCalls(timer)
+  let reply = pyeval("cindexclient.Poll(" . s:calls_request . ")")
+  if !reply.done
+    return
+  endif
+  call timer_stop(a:timer)
+  unlet s:calls_timer
+  if reply.failed
+    let l:command = s:CallsCommand(s:calls_word, s:calls_offset)
+    call s:ShowCallsPage(split(s:SystemMessage(l:command), '\v\n'))
+  else
+    call s:ShowCallsPage(reply.lines)
+  endif
+endfunction
+
+" Shows a page of calls, the server ends it with NEXT <offset> when there
+" are more of them
+function! s:ShowCallsPage(lines)
+  let lines = copy(a:lines)
+  if !empty(lines) && lines[-1] =~# '^NEXT \d\+$'
+    let s:calls_next = str2nr(split(remove(lines, -1))[1])
+  endif
+  call s:ShowCalls(lines, s:calls_offset > 0)
+  if exists('s:calls_next')
+    echo "cindex: more calls of " . s:calls_word . ", :CIMore lists them"
+  endif
+endfunction
+
+" Shows the given entries in the quickfix window, after the ones already
+" there when append is set
+function! s:ShowCalls(calls, ...)
   " Show list of calls in error area so it's easy to jump
-  let mylist = split(calls, '\v\n')
-  cgetexpr mylist
+  if a:0 && a:1
+    caddexpr a:calls
+  else
+    cgetexpr a:calls
+  endif
   botright copen 5
   " Auto-close
   let l:closemap = ':cclose<CR>'
   execute "nnoremap <buffer> <silent> <CR> <CR>" . l:closemap
 endfunction
 
+" Shows the functions calling the one under the cursor, when direction is
+" CALLERS, or called by it, when it is CALLEES, and so on up to depth calls
+" away, in the quickfix window
+function! cindex#CallHierarchy(direction, depth)
+  let wordUnderCursor = expand("<cword>")
+  let depth = str2nr(a:depth) > 0 ? str2nr(a:depth) : 1
+  let replies = cindex#Batch([{'cmd': a:direction, 'arg': wordUnderCursor,
+                             \ 'depth': depth}])
+  if type(replies) != type([])
+    echo join(cindex#Query(a:direction . " " . wordUnderCursor . " " . depth), "\n")
+    return
+  endif
+  if empty(replies[0])
+    echo "cindex: no " . tolower(a:direction) . " of " . wordUnderCursor
+    return
+  endif
+  let entries = []
+  for entry in replies[0]
+    let name = repeat('  ', entry.depth - 1) . entry.name
+    if has_key(entry, 'file')
+      call add(entries, entry.file . ':' . entry.line . ':' . entry.column .
+            \ ':' . name)
+    else
+      call add(entries, name)
+    endif
+  endfor
+  call s:ShowCalls(entries)
+endfunction
+
+" Lists the functions and types whose name contains or fuzzily matches
+" pattern in the quickfix window, at their declaration
+function! cindex#Find(pattern)
+  let replies = cindex#Batch([{'cmd': 'FIND', 'arg': a:pattern}])
+  if type(replies) != type([])
+    echo join(cindex#Query("FIND " . a:pattern), "\n")
+    return
+  endif
+  let names = replies[0]
+  if empty(names)
+    echo "No match for " . a:pattern
+    return
+  endif
+  let locations = cindex#Batch(map(copy(names), "{'cmd': 'DECL', 'arg': v:val}"))
+  let entries = []
+  for i in range(len(names))
+    if type(locations) == type([]) && !empty(locations[i])
+      let location = locations[i][0]
+      call add(entries, location.file . ':' . location.line . ':' .
+            \ location.column . ':' . names[i])
+    endif
+  endfor
+  call s:ShowCalls(entries)
+endfunction
+
 function s:SetupPython()
 python << endpython
 import os
@@ -89,6 +330,10 @@ import traceback
 import vim
 # Add python sources folder to the system path.
 debug_server = vim.eval('g:cindex_debug_server')
+jobs = vim.eval('g:cindex_jobs')
+cache_dir = vim.eval('expand(g:cindex_cache_dir)')
+include = vim.eval('g:cindex_include')
+exclude = vim.eval('g:cindex_exclude')
 script_folder = vim.eval( 's:script_folder_path' )
 include_folder = os.path.join( script_folder, '..', 'python' )
 sys.path.insert( 0, include_folder )
@@ -98,7 +343,10 @@ try:
     import clang.cindex
     import watchdog
     from cindex.setup import SetupCIndex
-    cindexer = SetupCIndex(debug_server)
+    cindexer = None
+    # Otherwise the server runs in a daemon shared with other Vim instances
+    if not int(vim.eval('g:cindex_daemon')):
+        cindexer = SetupCIndex(debug_server, jobs, cache_dir, include, exclude)
 except ImportError:
     vim.command( 'redraw | echohl WarningMsg' )
     vim.command( "echo 'CIndex unavailable'" )
@@ -129,5 +377,21 @@ function s:SetupCommands()
     command! CIStopServer call cindex#StopServer()
     command! CIIndex call cindex#Reindex()
     command! CICalls call cindex#Calls()
+    command! CIMore call cindex#More()
+    command! CIIndexBuffer call cindex#IndexBuffer()
+    command! -nargs=1 CIFind call cindex#Find(<q-args>)
+    command! CIProgress call cindex#Progress()
+    command! -nargs=? CICallers call cindex#CallHierarchy('CALLERS', <q-args>)
+    command! -nargs=? CICallees call cindex#CallHierarchy('CALLEES', <q-args>)
+endfunction
+
+function s:SetupAutoCommands()
+    if g:cindex_index_buffers
+      augroup cindexBuffers
+        autocmd!
+        autocmd CursorHold,InsertLeave *.c,*.cc,*.cpp,*.cxx,*.m,*.mm,*.h,*.hh,*.hpp
+              \ if &modified && exists('s:cindex_address') | call cindex#IndexBuffer() | endif
+      augroup END
+    endif
 endfunction
 
@@ -29,6 +29,41 @@ if !exists("g:cindex_debug_server")
   let g:cindex_debug_server = 0
 endif
 
+" Number of processes used to index, 0 means one per core
+if !exists("g:cindex_jobs")
+  let g:cindex_jobs = 0
+endif
+
+" Index modified buffers before they are written
+if !exists("g:cindex_index_buffers")
+  let g:cindex_index_buffers = 1
+endif
+
+" Where to keep the index between sessions, empty to disable
+if !exists("g:cindex_cache_dir")
+  let g:cindex_cache_dir = "~/.cache/vim-cindex"
+endif
+
+" Globs of the files to index, all of them when empty
+if !exists("g:cindex_include")
+  let g:cindex_include = []
+endif
+
+" Globs of the files and directories not to index, on top of .gitignore
+if !exists("g:cindex_exclude")
+  let g:cindex_exclude = []
+endif
+
+" Share the index of a project with other Vim instances through a daemon
+if !exists("g:cindex_daemon")
+  let g:cindex_daemon = 1
+endif
+
+" Number of calls listed at once, :CIMore lists the next ones, 0 for all
+if !exists("g:cindex_page_size")
+  let g:cindex_page_size = 1000
+endif
+
 " On-demand loading. Let's use the autoload folder and not slow down vim's
 " startup procedure.
 if has( 'vim_starting' ) " loading at startup
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""Offline benchmarks of the indexer and the server.
+
+Generates a synthetic C or C++ tree, then measures:
+    - cold IndexDirectory throughput
+    - reindex latency of a single file
+    - IMPL/DECL/CALLS/CALLERS/AUTO/FIND latency through Server and Searcher
+    - latency between a file being saved and its new content being queryable
+    - peak RSS
+and prints the results as JSON so that runs can be compared.
+
+    python benchmark.py --files 500 --functions 20 --calls 8 --output run.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIR_OF_CURRENT_SCRIPT, ".."))
+from cindex.search import Searcher
+from cindex.server import Server
+
+
+def generate_corpus(root, files=100, functions=20, calls=5, headers=10,
+                    fan_in=3, cpp=False, seed=0):
+    """Writes a synthetic tree under root and returns the list of function
+    names it defines.
+
+    Each of the files sources defines functions functions, each of them
+    calling calls functions picked at random. Declarations are spread over
+    headers headers, every source includes the one declaring its functions
+    and fan_in others."""
+    rng = random.Random(seed)
+    ext = '.cpp' if cpp else '.c'
+    include_dir = os.path.join(root, 'include')
+    source_dir = os.path.join(root, 'src')
+    for path in (include_dir, source_dir):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    headers = max(1, headers)
+    names = ['fn_%d_%d' % (i, j) for i in range(files) for j in range(functions)]
+    # name -> index of the header declaring it, the same for all the
+    # functions of a source
+    header_of = dict((name, (idx // functions) % headers)
+                     for idx, name in enumerate(names))
+    declared = [[] for _ in range(headers)]
+    for name in names:
+        declared[header_of[name]].append(name)
+
+    for h, header_names in enumerate(declared):
+        lines = ['#ifndef BENCH_H%d' % h, '#define BENCH_H%d' % h, '',
+                 'typedef struct { int a; int b; } bench_t%d;' % h, '']
+        lines.extend('int %s(bench_t%d *arg, int value);' % (name, h)
+                     for name in header_names)
+        lines.extend(['', '#endif', ''])
+        with open(os.path.join(include_dir, 'h%d.h' % h), 'w') as f:
+            f.write('\n'.join(lines))
+
+    for i in range(files):
+        own = i % headers
+        others = [h for h in range(headers) if h != own]
+        included = [own] + rng.sample(others, min(fan_in, len(others)))
+        # Only call functions which are declared by an included header
+        callable_names = [name for h in included for name in declared[h]]
+        lines = ['#include "../include/h%d.h"' % h for h in included]
+        lines.append('')
+        for j in range(functions):
+            name = 'fn_%d_%d' % (i, j)
+            lines.append('int %s(bench_t%d *arg, int value)' %
+                         (name, header_of[name]))
+            lines.append('{')
+            lines.append('    int total = value;')
+            for _ in range(calls if callable_names else 0):
+                callee = rng.choice(callable_names)
+                lines.append('    total += %s((bench_t%d *)arg, total);' %
+                             (callee, header_of[callee]))
+            lines.append('    return total;')
+            lines.append('}')
+            lines.append('')
+        with open(os.path.join(source_dir, 'f%d%s' % (i, ext)), 'w') as f:
+            f.write('\n'.join(lines))
+    return names
+
+
+def peak_rss():
+    """Peak resident set size in bytes of this process and of its waited for
+    children, the indexing workers."""
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {'self': own, 'children': children}
+
+
+def summarize(samples):
+    """Returns min, median, p95, max and mean of a list of seconds, in
+    milliseconds."""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    count = len(samples)
+    return {
+        'count': count,
+        'min_ms': samples[0] * 1000.0,
+        'median_ms': samples[count // 2] * 1000.0,
+        'p95_ms': samples[min(count - 1, int(count * 0.95))] * 1000.0,
+        'max_ms': samples[-1] * 1000.0,
+        'mean_ms': sum(samples) * 1000.0 / count,
+    }
+
+
+def bench_cold_index(server, root):
+    sources = server.indexer.find_source_files(root)
+    t0 = time.time()
+    server.indexer.IndexDirectory(root)
+    elapsed = time.time() - t0
+    return {
+        'files': len(sources),
+        'functions': len(server.indexer.store.functions),
+        'types': len(server.indexer.store.types),
+        'seconds': elapsed,
+        'files_per_second': len(sources) / elapsed if elapsed else None,
+    }
+
+
+def bench_reindex(server, filename, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.time()
+        server.indexer.Index([filename])
+        samples.append(time.time() - t0)
+    return summarize(samples)
+
+
+def _connect(port, timeout=10.0):
+    searcher = Searcher(port, persistent=True)
+    deadline = time.time() + timeout
+    while searcher.queue() is None:
+        if time.time() > deadline:
+            raise socket.error('Server did not start on port %d' % port)
+        time.sleep(0.05)
+    return searcher
+
+
+def bench_queries(searcher, names, rounds, rng):
+    """Latency of each query kind, as seen by a client reusing its
+    connection."""
+    queries = {
+        'IMPL': searcher.implementation,
+        'DECL': searcher.declaration,
+        'CALLS': searcher.calls,
+        'CALLERS': lambda name: searcher.callers(name, 3),
+        'AUTO': lambda name: searcher.complete(name[:len(name) // 2], 50),
+        'FIND': lambda name: searcher.find(name[2:len(name) // 2 + 2], 50),
+    }
+    results = {}
+    for cmd, query in sorted(queries.items()):
+        samples = []
+        for _ in range(rounds):
+            name = rng.choice(names)
+            t0 = time.time()
+            query(name)
+            samples.append(time.time() - t0)
+        results[cmd] = summarize(samples)
+    return results
+
+
+def bench_save_to_queryable(server, filename, rounds, timeout=10.0):
+    """Appends a new function to filename and waits for the file monitor to
+    make it available through IMPL."""
+    if not server.indexer.watcher:
+        return None
+    with open(filename) as f:
+        original = f.read()
+    samples = []
+    try:
+        for i in range(rounds):
+            name = 'bench_saved_%d' % i
+            t0 = time.time()
+            with open(filename, 'w') as f:
+                f.write(original)
+                f.write('\nint %s(void)\n{\n    return %d;\n}\n' % (name, i))
+            while not server.indexer.Implementation(name):
+                if time.time() - t0 > timeout:
+                    break
+                time.sleep(0.001)
+            else:
+                samples.append(time.time() - t0)
+    finally:
+        with open(filename, 'w') as f:
+            f.write(original)
+    return summarize(samples)
+
+
+def run(args):
+    log_file = False if not args.verbose else None
+    root = args.root or tempfile.mkdtemp(prefix='cindex-bench-')
+    rng = random.Random(args.seed)
+    try:
+        t0 = time.time()
+        names = generate_corpus(root, args.files, args.functions, args.calls,
+                                args.headers, args.fan_in, args.cpp, args.seed)
+        generated = time.time() - t0
+
+        server = Server(log_file=log_file, jobs=args.jobs,
+                        cache_dir=args.cache)
+        report = {
+            'config': {
+                'files': args.files,
+                'functions': args.functions,
+                'calls': args.calls,
+                'headers': args.headers,
+                'fan_in': args.fan_in,
+                'cpp': args.cpp,
+                'jobs': server.indexer.jobs,
+                'cache': bool(args.cache),
+                'seed': args.seed,
+            },
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'generate_seconds': generated,
+        }
+        report['cold_index'] = bench_cold_index(server, root)
+
+        ext = '.cpp' if args.cpp else '.c'
+        target = os.path.join(root, 'src', 'f0%s' % ext)
+        report['reindex'] = bench_reindex(server, target, args.rounds)
+
+        port = server.StartServer(Server.get_unused_local_port())
+        searcher = _connect(port)
+        try:
+            report['queries'] = bench_queries(searcher, names, args.queries, rng)
+        finally:
+            server.StopServer()
+            searcher.close()
+
+        report['save_to_queryable'] = bench_save_to_queryable(
+            server, target, args.rounds)
+        if server.indexer.watcher:
+            server.indexer.watcher.Stop()
+            # Let the monitor go before the corpus is deleted under it
+            server.indexer.watcher.observer.join()
+        report['peak_rss'] = peak_rss()
+        report['stats'] = server.indexer.Stats()
+        return report
+    finally:
+        if not args.root and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', default=200, type=int,
+                        help='Number of source files.')
+    parser.add_argument('--functions', default=20, type=int,
+                        help='Number of functions per source file.')
+    parser.add_argument('--calls', default=5, type=int,
+                        help='Number of calls in each function.')
+    parser.add_argument('--headers', default=20, type=int,
+                        help='Number of headers.')
+    parser.add_argument('--fan_in', default=3, type=int,
+                        help='Number of headers included by each source.')
+    parser.add_argument('--cpp', default=False, action='store_true',
+                        help='Generate C++ instead of C sources.')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='Number of indexing processes, 0 for one per core.')
+    parser.add_argument('--cache',
+                        help='Directory where to keep the index cache.')
+    parser.add_argument('--rounds', default=10, type=int,
+                        help='Number of reindex and save rounds.')
+    parser.add_argument('--queries', default=200, type=int,
+                        help='Number of queries of each kind.')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed of the corpus generator.')
+    parser.add_argument('--root',
+                        help='Generate the corpus there instead of in a '
+                        'temporary directory, kept afterwards.')
+    parser.add_argument('--keep', default=False, action='store_true',
+                        help='Keep the temporary corpus.')
+    parser.add_argument('--output',
+                        help='Write the JSON report there instead of stdout.')
+    parser.add_argument('--verbose', default=False, action='store_true',
+                        help='Log indexing to stderr.')
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
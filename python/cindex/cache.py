@@ -0,0 +1,104 @@
+import hashlib
+import marshal
+import os
+import sqlite3
+import threading
+
+from cindex.storage import group_records
+
+# Bump whenever the layout of the records changes, older caches are then
+# discarded.
+CACHE_VERSION = 4
+
+
+def file_digest(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class IndexCache(object):
+    """Persistent store of the records contributed by each indexed file,
+    along with the file mtime, size and content hash so that unchanged files
+    can be loaded without going through libclang. Records are kept grouped by
+    group_records, ready for SymbolStore.Load."""
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._setup()
+
+    @staticmethod
+    def path_for(cache_dir, root):
+        """One cache database per indexed root."""
+        key = file_digest(os.path.abspath(root))
+        return os.path.join(cache_dir, '%s.db' % key)
+
+    def _setup(self):
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+                            '(key TEXT PRIMARY KEY, value TEXT)')
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or int(row[0]) != CACHE_VERSION:
+                if row is not None:
+                    self.logger.info('Discarding cache %s (version %s)',
+                                     self.path, row[0])
+                self.db.execute('DROP TABLE IF EXISTS files')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES "
+                                "('version', ?)", (str(CACHE_VERSION),))
+            self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                            '(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                            'digest TEXT, records BLOB)')
+            self.db.commit()
+
+    def Load(self):
+        """Returns a dict of path -> (mtime, size, digest, rows), rows being
+        the records grouped by group_records."""
+        entries = {}
+        with self.lock:
+            cursor = self.db.execute(
+                'SELECT path, mtime, size, digest, records FROM files')
+            for path, mtime, size, digest, records in cursor:
+                entries[path] = (mtime, size, digest,
+                                 marshal.loads(bytes(records)))
+        return entries
+
+    def Store(self, entries):
+        """Saves a list of (path, mtime, size, digest, records)."""
+        if not entries:
+            return
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                [(path, mtime, size, digest,
+                  sqlite3.Binary(marshal.dumps(group_records(records))))
+                 for path, mtime, size, digest, records in entries])
+            self.db.commit()
+
+    def Touch(self, entries):
+        """Updates the mtime of a list of (path, mtime) whose content did not
+        change."""
+        if not entries:
+            return
+        with self.lock:
+            self.db.executemany('UPDATE files SET mtime = ? WHERE path = ?',
+                                [(mtime, path) for path, mtime in entries])
+            self.db.commit()
+
+    def Remove(self, files):
+        if not files:
+            return
+        with self.lock:
+            self.db.executemany('DELETE FROM files WHERE path = ?',
+                                [(path,) for path in files])
+            self.db.commit()
+
+    def Close(self):
+        with self.lock:
+            self.db.close()
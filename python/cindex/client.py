@@ -0,0 +1,92 @@
+import threading
+
+from cindex.search import Searcher
+
+
+class Client(object):
+    """Long lived connection to the server used from within Vim.
+
+    Lookups reuse a single socket instead of spawning search.py. Slow queries
+    such as CALLS can run in the background and be polled from a Vim timer,
+    each on a connection of its own so that lookups made in the meantime do
+    not wait for them."""
+
+    def __init__(self, port=None, path=None, attach=False):
+        self.port = port
+        self.path = path
+        self.searcher = Searcher(port, persistent=True, path=path)
+        if attach:
+            # Keeps the daemon at path alive until the connection is closed,
+            # attached again whenever the connection is opened again
+            self.searcher.greeting = "ATTACH\n"
+        self.lock = threading.Lock()
+        # id -> Searcher of the requests in progress
+        self.pending = {}
+        # id -> reply lines of the requests done but not polled yet
+        self.results = {}
+        self.next_id = 0
+
+    def Command(self, message):
+        """Returns the reply lines or None if the server is unreachable."""
+        return self.searcher.command(message)
+
+    def Batch(self, queries):
+        """Returns the results of each query, or None if the server is
+        unreachable."""
+        return self.searcher.batch(queries)
+
+    def Submit(self, message):
+        """Runs the command in the background and returns an id to Poll, or
+        to Cancel if its reply is not wanted anymore."""
+        return self._submit(lambda searcher: searcher.command(message))
+
+    def SubmitBatch(self, queries):
+        """Runs a batch of queries in the background, as Submit does. The
+        lines polled are the results of each query."""
+        return self._submit(lambda searcher: searcher.batch(queries))
+
+    def _submit(self, send):
+        searcher = Searcher(self.port, path=self.path)
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = searcher
+
+        def run():
+            lines = send(searcher)
+            with self.lock:
+                # Dropped if cancelled in the meantime
+                if self.pending.pop(request_id, None):
+                    self.results[request_id] = lines
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return request_id
+
+    def Poll(self, request_id):
+        """Returns a dict suitable for pyeval(), done is 0 until the reply
+        arrived and failed is 1 if the server could not be reached."""
+        with self.lock:
+            if request_id not in self.results:
+                return {'done': 0}
+            lines = self.results.pop(request_id)
+        if lines is None:
+            return {'done': 1, 'failed': 1, 'lines': []}
+        return {'done': 1, 'failed': 0, 'lines': lines}
+
+    def Cancel(self, request_id):
+        """Forgets a request, closing its connection if it is still in
+        progress."""
+        with self.lock:
+            searcher = self.pending.pop(request_id, None)
+            self.results.pop(request_id, None)
+        if searcher:
+            searcher.abort()
+
+    def Close(self):
+        with self.lock:
+            request_ids = list(self.pending)
+        for request_id in request_ids:
+            self.Cancel(request_id)
+        self.searcher.close()
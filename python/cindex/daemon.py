@@ -0,0 +1,156 @@
+import errno
+import hashlib
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(DIR_OF_CURRENT_SCRIPT, 'server.py')
+
+# Directories marking the root of a project
+ROOT_MARKERS = ['.git', '.hg', '.svn']
+
+
+def available():
+    """Daemons are reached through Unix domain sockets, in a directory only
+    the user can access."""
+    if fcntl is None or not hasattr(socket, 'AF_UNIX'):
+        return False
+    try:
+        runtime_dir()
+    except OSError:
+        return False
+    return True
+
+
+def project_root(path):
+    """Returns the closest directory above path holding a version control
+    directory, or path itself when there is none."""
+    path = os.path.abspath(path)
+    current = path
+    while True:
+        for marker in ROOT_MARKERS:
+            if os.path.exists(os.path.join(current, marker)):
+                return current
+        parent = os.path.dirname(current)
+        if parent == current:
+            return path
+        current = parent
+
+
+def runtime_dir():
+    """Returns the directory of the sockets, locks and logs of the daemons of
+    the user. Raises OSError when it is not a directory owned by the user and
+    closed to others, someone else could otherwise answer in place of a
+    daemon or read what it logs."""
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    path = os.path.join(base, 'vim-cindex-%d' % os.getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as er:
+        if er.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            stat.S_IMODE(st.st_mode) & 0o077):
+        raise OSError(errno.EPERM, 'Not a private directory', path)
+    return path
+
+
+def _path(root, ext):
+    key = hashlib.sha1(os.path.abspath(root).encode('utf-8')).hexdigest()
+    return os.path.join(runtime_dir(), key[:16] + ext)
+
+
+def socket_path(root):
+    return _path(root, '.sock')
+
+
+def lock_path(root):
+    return _path(root, '.lock')
+
+
+def log_path(root):
+    return _path(root, '.log')
+
+
+def acquire_lock(root):
+    """Returns the descriptor of the lock file of root, held until it is
+    closed, or None if another daemon holds it. The lock file tells the pid
+    of its holder and the root it serves."""
+    fd = os.open(lock_path(root), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+    os.ftruncate(fd, 0)
+    os.write(fd, ('%d %s\n' % (os.getpid(), root)).encode('utf-8'))
+    return fd
+
+
+def find_daemon(root):
+    """Returns the path of the socket of the daemon serving root, or None
+    if there is none."""
+    if not available():
+        return None
+    path = socket_path(root)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        # Left behind by a daemon which did not exit cleanly
+        return None
+    finally:
+        sock.close()
+    return path
+
+
+def detach():
+    """Turns the current process into a daemon, the parent exits once the
+    child is on its own."""
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+
+
+def _python():
+    # Within Vim sys.executable may be Vim itself
+    if os.path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+    return 'python%d' % sys.version_info[0]
+
+
+def spawn(root, args=(), timeout=10.0):
+    """Starts a daemon serving root with the given server.py options and
+    returns the path of its socket once it accepts connections, or None if
+    it did not within timeout seconds. Its output goes to log_path(root)."""
+    command = [_python(), SERVER_SCRIPT, '--daemon', root] + list(args)
+    with open(log_path(root), 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=log,
+                                   close_fds=True)
+    # Returns as soon as the daemon detached itself
+    process.wait()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        path = find_daemon(root)
+        if path:
+            return path
+        time.sleep(0.05)
+    return None
@@ -0,0 +1,326 @@
+import functools
+import os
+import re
+import threading
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+IGNORE_FILE = '.gitignore'
+# Never worth looking into
+SKIPPED_DIRECTORIES = frozenset(['.git', '.hg', '.svn'])
+
+
+def translate(pattern):
+    """Returns the regex matching the paths, relative to the directory of a
+    gitignore style pattern, matched by it. * and ? do not match /, **
+    matches any number of directories and a pattern without a / matches at
+    any depth."""
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 3] == '**/':
+                regex.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern[i:i + 2] == '**':
+                regex.append('.*')
+                i += 2
+                continue
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[' and pattern.find(']', i + 2) > 0:
+            end = pattern.find(']', i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex.append('[%s]' % body)
+            i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return ('' if anchored else '(?:.*/)?') + ''.join(regex) + '$'
+
+
+class IgnoreRules(object):
+    """Patterns of a .gitignore file, or globs given in the same syntax,
+    matched against / separated paths relative to their directory. The last
+    matching pattern wins, a pattern starting with ! includes back what
+    previous ones ignored and one ending with / only matches directories."""
+
+    def __init__(self, lines):
+        # (regex, negated, directories only)
+        self.rules = []
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            line = line.rstrip()
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+            if line:
+                self.rules.append((translate(line), negated, directory_only))
+        # Without negated patterns any match will do, a single regex per kind
+        # of path is much faster than trying each pattern in turn
+        self.files = self.directories = None
+        if not any(negated for _, negated, _ in self.rules):
+            self.files = self._combine(
+                [regex for regex, _, directory_only in self.rules
+                 if not directory_only])
+            self.directories = self._combine(
+                [regex for regex, _, _ in self.rules])
+        self.rules = [(re.compile(regex), negated, directory_only)
+                      for regex, negated, directory_only in self.rules]
+
+    @staticmethod
+    def _combine(regexes):
+        if not regexes:
+            return None
+        return re.compile('|'.join('(?:%s)' % regex for regex in regexes))
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def Load(cls, path):
+        """Rules of the file at path, None when there is none."""
+        try:
+            with open(path) as f:
+                rules = cls(f.readlines())
+        except (IOError, OSError):
+            return None
+        return rules if rules else None
+
+    def Match(self, path, is_dir):
+        """Returns True when path is ignored, False when a negated pattern
+        includes it back and None when no pattern matches it."""
+        if self.directories is not None:
+            regex = self.directories if is_dir else self.files
+            return True if regex and regex.match(path) else None
+        for regex, negated, directory_only in reversed(self.rules):
+            if directory_only and not is_dir:
+                continue
+            if regex.match(path):
+                return not negated
+        return None
+
+
+def _list_directory(directory):
+    """Returns the (name, is_dir, stat) of the entries of directory, stat
+    being a function returning the stat of the entry. Links to directories
+    are not followed, as os.walk does."""
+    entries = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            try:
+                is_dir = entry.is_dir() and not entry.is_symlink()
+            except OSError:
+                continue
+            entries.append((entry.name, is_dir, entry.stat))
+        return entries
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        is_dir = os.path.isdir(path) and not os.path.islink(path)
+        entries.append((name, is_dir, functools.partial(os.stat, path)))
+    return entries
+
+
+def diff_manifest(previous, current):
+    """Returns the lists of files added, changed and removed between two
+    dicts of path -> (mtime, size)."""
+    added = []
+    changed = []
+    for path, state in current.items():
+        previous_state = previous.get(path)
+        if previous_state is None:
+            added.append(path)
+        elif previous_state != state:
+            changed.append(path)
+    removed = [path for path in previous if path not in current]
+    return added, changed, removed
+
+
+class SourceFinder(object):
+    """Lists the source files under a directory along with their mtime and
+    size, leaving out what .gitignore files and the exclude globs rule out
+    and, when include globs are given, what none of them matches.
+
+    Directories are listed by a pool of threads, most of the time is spent in
+    system calls which let the other threads run."""
+
+    def __init__(self, extensions, include=(), exclude=(), threads=8,
+                 gitignore=True):
+        self.extensions = frozenset(extensions)
+        self.include = IgnoreRules(include) if include else None
+        self.exclude = IgnoreRules(exclude)
+        self.threads = threads
+        self.gitignore = gitignore
+        # Directory -> list of (directory, IgnoreRules) of the .gitignore
+        # files applying to its entries
+        self.rules = {}
+
+    def Invalidate(self):
+        """Forgets the .gitignore files read so far."""
+        self.rules = {}
+
+    def _rules(self, directory, root):
+        rules = self.rules.get(directory)
+        if rules is None:
+            parent = os.path.dirname(directory)
+            if directory == root or parent == directory:
+                rules = []
+            else:
+                rules = self._rules(parent, root)
+            own = None
+            if self.gitignore:
+                own = IgnoreRules.Load(os.path.join(directory, IGNORE_FILE))
+            if own:
+                rules = rules + [(os.path.join(directory, ''), own)]
+            self.rules[directory] = rules
+        return rules
+
+    def _ignored(self, path, prefix, is_dir, rules):
+        if self.exclude and self.exclude.Match(
+                path[len(prefix):].replace(os.sep, '/'), is_dir):
+            return True
+        # Deeper .gitignore files take precedence
+        for base, own in reversed(rules):
+            ignored = own.Match(path[len(base):].replace(os.sep, '/'), is_dir)
+            if ignored is not None:
+                return ignored
+        return False
+
+    def _included(self, path):
+        """Whether an include glob matches path, relative to the root, or the
+        closest of its parent directories matched by one."""
+        included = self.include.Match(path, False)
+        while included is None and '/' in path:
+            path = path.rsplit('/', 1)[0]
+            included = self.include.Match(path, True)
+        return bool(included)
+
+    def _wanted(self, path, prefix, rules):
+        if self._ignored(path, prefix, False, rules):
+            return False
+        return not self.include or self._included(
+            path[len(prefix):].replace(os.sep, '/'))
+
+    def _scan(self, directory, root, prefix):
+        """Returns the directories to descend into and the dict of source
+        path -> (mtime, size) of directory."""
+        rules = self._rules(directory, root)
+        subdirs = []
+        sources = {}
+        try:
+            entries = _list_directory(directory)
+        except OSError:
+            return subdirs, sources
+        for name, is_dir, stat in entries:
+            path = os.path.join(directory, name)
+            if is_dir:
+                if (name not in SKIPPED_DIRECTORIES and
+                        not self._ignored(path, prefix, True, rules)):
+                    subdirs.append(path)
+            elif (os.path.splitext(name)[1] in self.extensions and
+                    self._wanted(path, prefix, rules)):
+                try:
+                    st = stat()
+                except OSError:
+                    continue
+                sources[path] = (st.st_mtime, st.st_size)
+        return subdirs, sources
+
+    def _visible(self, path, root, prefix):
+        """Whether the directories between root and path are looked into."""
+        directory = root
+        for name in path[len(prefix):].split(os.sep)[:-1]:
+            rules = self._rules(directory, root)
+            directory = os.path.join(directory, name)
+            if (name in SKIPPED_DIRECTORIES or
+                    self._ignored(directory, prefix, True, rules)):
+                return False
+        return True
+
+    def Matches(self, root, path):
+        """Whether Find would list path, a file under root."""
+        if os.path.splitext(path)[1] not in self.extensions:
+            return False
+        prefix = os.path.join(root, '')
+        if not path.startswith(prefix) or not self._visible(path, root, prefix):
+            return False
+        return self._wanted(path, prefix,
+                            self._rules(os.path.dirname(path), root))
+
+    def Find(self, root, top=None):
+        """Returns a dict of path -> (mtime, size) of the source files under
+        top, a directory under root, or under root itself. The .gitignore
+        files are read again when listing root."""
+        prefix = os.path.join(root, '')
+        if top is None:
+            top = root
+            self.Invalidate()
+        elif not top.startswith(prefix) or not self._visible(
+                os.path.join(top, ''), root, prefix):
+            return {}
+        if self.threads <= 1:
+            sources = {}
+            pending = [top]
+            while pending:
+                subdirs, found = self._scan(pending.pop(), root, prefix)
+                pending.extend(subdirs)
+                sources.update(found)
+            return sources
+        return self._find_parallel(top, root, prefix)
+
+    def _find_parallel(self, top, root, prefix):
+        pending = Queue()
+        sources = {}
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                directory = pending.get()
+                if directory is None:
+                    return
+                try:
+                    subdirs, found = self._scan(directory, root, prefix)
+                    # Queued before this directory is marked done so that
+                    # join does not return early
+                    for subdir in subdirs:
+                        pending.put(subdir)
+                    with lock:
+                        sources.update(found)
+                finally:
+                    pending.task_done()
+
+        pending.put(top)
+        workers = [threading.Thread(target=work) for _ in range(self.threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        pending.join()
+        for worker in workers:
+            pending.put(None)
+        return sources
@@ -1,270 +1,918 @@
 import clang.cindex
+import contextlib
+import itertools
 import logging
+import multiprocessing
 import os
 import platform
 import re
 import sys
+import threading
 import time
 
+from cindex.cache import IndexCache, file_digest
+from cindex.discovery import SourceFinder, diff_manifest
+from cindex.journal import IndexJournal
+from cindex.storage import SymbolStore
+from cindex.snippets import SnippetCache
+from cindex.stats import IndexStats
+from cindex.tucache import TranslationUnitCache
+
+SOURCE_EXTENSIONS = ['.c', '.cc', '.cpp', '.cxx', '.m', '.mm',
+                     '.h', '.hh', '.hpp']
+HEADER_EXTENSIONS = ['.h', '.hh', '.hpp']
+
+# Incremental batches smaller than that, such as the files written by :wa,
+# are parsed in the indexing thread where their translation units are kept
+# for the next change, rather than by a pool of freshly forked workers
+SERIAL_BATCH = 16
+
+
+def setup_clang():
+    if clang.cindex.Config.loaded:
+        return
+    if platform.platform().startswith('Darwin'):
+        lib_path = '/Library/Developer/CommandLineTools/usr/lib/libclang.dylib'
+        clang.cindex.Config.set_library_file(lib_path)
+    elif platform.platform().startswith('Linux'):
+        lib_path = '/usr/lib/youcompleteme/third_party/ycmd/libclang.so'
+        clang.cindex.Config.set_library_file(lib_path)
+    else:
+        from ctypes.util import find_library
+        clang.cindex.Config.set_library_file(find_library('clang'))
+
+
+# Kinds of cursors we extract records from
+_FUNCTION_DECL = clang.cindex.CursorKind.FUNCTION_DECL
+_TYPEDEF_DECL = clang.cindex.CursorKind.TYPEDEF_DECL
+_CALL_EXPR = clang.cindex.CursorKind.CALL_EXPR
+_TYPE_REF = clang.cindex.CursorKind.TYPE_REF
+_INDEXED_KINDS = frozenset(
+    [_FUNCTION_DECL, _TYPEDEF_DECL, _CALL_EXPR, _TYPE_REF])
+
+# Kinds of cursors which can not hold any of the above
+_LEAF_KINDS = frozenset([
+    clang.cindex.CursorKind.INTEGER_LITERAL,
+    clang.cindex.CursorKind.FLOATING_LITERAL,
+    clang.cindex.CursorKind.IMAGINARY_LITERAL,
+    clang.cindex.CursorKind.STRING_LITERAL,
+    clang.cindex.CursorKind.CHARACTER_LITERAL,
+    clang.cindex.CursorKind.CXX_BOOL_LITERAL_EXPR,
+    clang.cindex.CursorKind.CXX_NULL_PTR_LITERAL_EXPR,
+    clang.cindex.CursorKind.NAMESPACE_REF,
+    clang.cindex.CursorKind.MEMBER_REF,
+    clang.cindex.CursorKind.LABEL_REF,
+])
+
+
+# Pushed after the subtree of a function to know when the walk leaves it
+_END_OF_FUNCTION = object()
+
+
+def is_header(filename):
+    return os.path.splitext(filename)[1] in HEADER_EXTENSIONS
+
+
+def _function_kind(filename):
+    if is_header(filename):
+        return 'DECL'
+    return 'IMPL'
+
+
+def extract_records(cursor, filename, timings=None, headers=None):
+    """Walk the AST of a translation unit and return the compact records found
+    in filename as (kind, name, line, column, caller) tuples, kind being one
+    of DECL, IMPL, CALL, TYPE or REF and caller the name of the function a
+    CALL is made from, None otherwise. The number of nodes visited is added
+    to the nodes entry of timings when given. headers maps included files
+    whose records should be collected as well to the list to append them to.
+
+    Top level cursors coming from other files, included headers, are skipped
+    along with their whole subtree. The walk is iterative so deep ASTs do not
+    hit the recursion limit."""
+    records = []
+    # file -> (records, kind of function declarations)
+    outputs = {filename: (records, _function_kind(filename))}
+    for header, header_records in (headers or {}).items():
+        outputs[header] = (header_records, _function_kind(header))
+
+    stack = []
+    for node in cursor.get_children():
+        location_file = node.location.file
+        if location_file and location_file.name in outputs:
+            stack.append(node)
+    stack.reverse()
+
+    nodes = 0
+    # Function the walk is in, restored from scopes once its subtree is done
+    scope = None
+    scopes = []
+    while stack:
+        node = stack.pop()
+        if node is _END_OF_FUNCTION:
+            scope = scopes.pop()
+            continue
+        nodes += 1
+        try:
+            kind = node.kind
+        except ValueError:
+            # Incompatible libclang and pyclang?
+            kind = None
+        if kind in _INDEXED_KINDS:
+            location = node.location
+            output = location.file and outputs.get(location.file.name)
+            if output:
+                if kind == _FUNCTION_DECL:
+                    output[0].append((output[1], node.spelling, location.line,
+                                      location.column, None))
+                elif kind == _TYPEDEF_DECL:
+                    output[0].append(('TYPE', node.spelling, location.line,
+                                      location.column, None))
+                elif kind == _CALL_EXPR:
+                    output[0].append(('CALL', node.spelling, location.line,
+                                      location.column, scope))
+                else:
+                    output[0].append(('REF', node.spelling, location.line,
+                                      location.column, None))
+        elif kind in _LEAF_KINDS:
+            continue
+
+        children = list(node.get_children())
+        if kind == _FUNCTION_DECL and children:
+            stack.append(_END_OF_FUNCTION)
+            scopes.append(scope)
+            scope = node.spelling
+        children.reverse()
+        stack.extend(children)
+    if timings is not None:
+        timings['nodes'] = timings.get('nodes', 0) + nodes
+    return records
+
+
+def file_state(filename, digest=True):
+    """Returns the (mtime, size, digest) of filename, the content is only read
+    when a digest is asked for."""
+    st = os.stat(filename)
+    content_digest = None
+    if digest:
+        with open(filename, 'rb') as f:
+            content_digest = file_digest(f.read())
+    return (st.st_mtime, st.st_size, content_digest)
+
+
+class IndexSuperseded(Exception):
+    """Raised within a pass over a directory once another one was asked
+    for."""
+
+
+def prioritize(files, priority):
+    """Orders files so that the ones in priority come first, in that order,
+    followed by the ones in the same directories, then by the others."""
+    if not priority:
+        return files
+    ranks = dict((filename, idx) for idx, filename in
+                 enumerate(reversed(priority)))
+    first = len(ranks)
+    directories = set(os.path.dirname(filename) for filename in priority)
+
+    def rank(filename):
+        if filename in ranks:
+            return first - ranks[filename]
+        if os.path.dirname(filename) in directories:
+            return first + 1
+        return first + 2
+    return sorted(files, key=rank)
+
+
+class HeaderHarvest(object):
+    """Headers whose records are collected from the first translation unit
+    including them instead of being parsed on their own.
+
+    known maps the headers already collected, or loaded from the cache, to
+    the (mtime, size, digest) they had then. They are skipped by the
+    following translation units until their content changes."""
+
+    def __init__(self, candidates=(), known=None):
+        # Headers worth collecting, the ones under the indexed directory
+        self.candidates = set(candidates)
+        self.known = dict(known or {})
+        # (header, records, state) collected since the last Take
+        self.harvested = []
+
+    def Wanted(self, tu):
+        """Returns a dict of the name of the headers included by tu which need
+        to be collected, as spelled by libclang, to their path and state."""
+        wanted = {}
+        seen = set()
+        for inclusion in tu.get_includes():
+            spelling = inclusion.include.name
+            # Included relatively to the includer, such as src/../include/a.h
+            header = os.path.normpath(spelling)
+            if header not in self.candidates or header in seen:
+                continue
+            seen.add(header)
+            known = self.known.get(header)
+            try:
+                st = os.stat(header)
+            except OSError:
+                continue
+            if known and known[:2] == (st.st_mtime, st.st_size):
+                continue
+            state = file_state(header)
+            if known and known[2] == state[2]:
+                # Touched but not modified
+                self.known[header] = state
+                continue
+            wanted[spelling] = (header, state)
+        return wanted
+
+    def Add(self, header, records, state):
+        self.known[header] = state
+        self.harvested.append((header, records, state))
+
+    def Take(self):
+        harvested = self.harvested
+        self.harvested = []
+        return harvested
+
+
+def parse_file(cindex, filename, includes, units=None, digest=True,
+               timings=None, harvest=None):
+    """Parse filename and returns its records along with the (mtime, size,
+    digest) state of the file they were extracted from. Translation units are
+    reused from units when given. The content is only read when a digest is
+    asked for. The seconds spent in each phase are added to timings when
+    given. Records of the headers wanted by harvest are added to it."""
+    if timings is None:
+        timings = {}
+    t0 = time.time()
+    state = file_state(filename, digest)
+    # Get AST from Clang
+    t1 = time.time()
+    if units is not None:
+        tu = units.Parse(filename)
+    else:
+        tu = cindex.parse(filename, includes)
+    t2 = time.time()
+    wanted = harvest.Wanted(tu) if harvest else {}
+    t3 = time.time()
+    headers = dict((spelling, []) for spelling in wanted)
+    records = extract_records(tu.cursor, filename, timings, headers)
+    for spelling, header_records in headers.items():
+        header, header_state = wanted[spelling]
+        harvest.Add(header, header_records, header_state)
+    t4 = time.time()
+    timings['read'] = timings.get('read', 0) + t1 - t0 + t3 - t2
+    timings['parse'] = timings.get('parse', 0) + t2 - t1
+    timings['walk'] = timings.get('walk', 0) + t4 - t3
+    return records, state
+
+
+# Per worker process state for parallel indexing, each worker owns its own
+# clang index.
+_worker_cindex = None
+_worker_includes = []
+_worker_digest = True
+_worker_harvest = None
+_worker_cancelled = None
+
+
+def _worker_init(includes, digest, headers=(), known=None, cancelled=None):
+    global _worker_cindex, _worker_includes, _worker_digest, _worker_harvest
+    global _worker_cancelled
+    setup_clang()
+    _worker_cindex = clang.cindex.Index.create()
+    _worker_includes = includes
+    _worker_digest = digest
+    _worker_cancelled = cancelled
+    if headers:
+        _worker_harvest = HeaderHarvest(headers, known)
+
+
+def _worker_parse(filename):
+    timings = {}
+    if _worker_cancelled is not None and _worker_cancelled.value:
+        return filename, None, None, timings, []
+    try:
+        records, state = parse_file(_worker_cindex, filename, _worker_includes,
+                                    digest=_worker_digest, timings=timings,
+                                    harvest=_worker_harvest)
+        harvested = _worker_harvest.Take() if _worker_harvest else []
+        return filename, records, state, timings, harvested
+    except (clang.cindex.TranslationUnitLoadError, IOError, OSError):
+        return filename, None, None, timings, []
+
 
 class Indexer(object):
 
-    def __init__(self, index_file=None, logger=None):
+    def __init__(self, index_file=None, logger=None, jobs=1, cache_dir=None,
+                 tu_cache_memory=256 * 1024 * 1024, harvest_headers=True,
+                 include=(), exclude=()):
         self.index_file = index_file
+        self.journal = None
+        self.cache_dir = cache_dir
+        self.cache = None
         self.server_thread = None
         self.includes = []
-        self.observer = None
+        self.watcher = None
+        # Lists the files to index, honouring .gitignore files and the
+        # include and exclude globs
+        self.finder = SourceFinder(SOURCE_EXTENSIONS, include, exclude)
+        # path -> (mtime, size) of the files of the directory last indexed,
+        # what the next pass over it is compared to
+        self.manifest = {}
+        self.manifest_root = None
+        # Collect the records of headers from the translation units including
+        # them rather than parsing them on their own
+        self.harvest_headers = harvest_headers
+        self.harvest = HeaderHarvest()
+        # Header -> translation unit its records were collected from
+        self.includers = {}
+        # Headers collected during the current pass
+        self.collected = set()
+        # Bumped by each pass over a directory, a pass stops as soon as it
+        # does not match the one it started with
+        self.generation = 0
+        self.generation_lock = threading.Lock()
+        self.pass_generation = None
+        # (generation, root) of the pass in progress, if any
+        self.pass_root = None
+        # Files parsed and to parse by the current pass
+        self.progress = None
+        # Counters and timers reported by the STATS command
+        self.stats = IndexStats()
+        # Serializes changes to the index between the indexing thread and
+        # the file monitor, taken through Changing()
+        self.lock = threading.RLock()
+        # Nesting of the Changing() blocks of the thread holding lock
+        self.changing = 0
+        # filename -> content of the unsaved buffers waiting for lock
+        self.buffers = {}
+        self.buffers_lock = threading.Lock()
+        # Held while a file's records are swapped so that queries never see
+        # a file half indexed
+        self.view_lock = threading.RLock()
         self._clear()
         self.logger = logger
+        # Number of worker processes used to parse files, 0 means one per
+        # core
+        if jobs <= 0:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = jobs
 
         # Setup clang
-        if platform.platform().startswith('Darwin'):
-            lib_path = '/Library/Developer/CommandLineTools/usr/lib/libclang.dylib'
-            clang.cindex.Config.set_library_file(lib_path)
-        elif platform.platform().startswith('Linux'):
-            lib_path = '/usr/lib/youcompleteme/third_party/ycmd/libclang.so'
-            clang.cindex.Config.set_library_file(lib_path)
-        else:
-            from ctypes.util import find_library
-            clang.cindex.Config.set_library_file(find_library('clang'))
+        setup_clang()
         self.cindex = clang.cindex.Index.create()
+        if index_file:
+            self.journal = IndexJournal(index_file, self.logger, self._snapshot)
+        # Source lines shown along with calls and references
+        self.snippets = SnippetCache()
+        # Live translation units of files reindexed after a change
+        self.units = TranslationUnitCache(
+            self.cindex, self.includes, tu_cache_memory, self.logger)
 
     def _clear(self):
-        self.functions = {}
-        self.types = {}
+        with self.view_lock:
+            self.store = SymbolStore()
+            # Where records are merged, a shadow store while a directory is
+            # reindexed
+            self.target = self.store
 
-    @staticmethod
-    def find_source_files(rootdir):
-        sources = []
-        for root, subdirs, files in os.walk(rootdir):
-            for filename in files:
-                if os.path.splitext(filename)[1] in ['.c', '.cpp', '.h', '.hpp']:
-                    filename = os.path.join(root, filename)
-                    sources.append(filename)
-        return sources
+    @contextlib.contextmanager
+    def Changing(self):
+        """Holds the lock serializing changes to the index. Buffers sent in
+        the meantime are indexed once the outermost block is done."""
+        self.lock.acquire()
+        self.changing += 1
+        try:
+            yield
+        finally:
+            self.changing -= 1
+            outermost = not self.changing
+            self.lock.release()
+            if outermost:
+                self._index_buffers()
 
-    def IndexDirectory(self, root):
-        sources = self.find_source_files(root)
-        self._clear()
-        self.Index(sources, root)
+    def find_source_files(self, rootdir):
+        return sorted(self.finder.Find(rootdir))
+
+    def IndexDirectory(self, root, priority=None):
+        """Indexes everything under root, the files in priority and their
+        directories first.
+
+        The new index is built aside while the current one keeps answering
+        queries, and replaces it once complete. The very first pass has
+        nothing to keep so it fills the index in place, queries get partial
+        results as files are indexed. Following passes over the same root
+        only go through the files added, changed or removed since the
+        previous one, in place. A pass started while another one runs makes
+        the latter stop as soon as possible, see Indexing() to avoid that."""
+        with self.generation_lock:
+            self.generation += 1
+            generation = self.generation
+            self.pass_root = (generation, root)
+        t0 = time.time()
+        manifest = self.finder.Find(root)
+        elapsed = time.time() - t0
+        self.stats.Time('discover', elapsed)
+        self.logger.info('Found %d file(s) under %s in %0.3f ms',
+                         len(manifest), root, elapsed * 1000.0)
+        with self.Changing():
+            if generation != self.generation:
+                # Superseded while looking for files
+                return False
+            self.pass_generation = generation
+            try:
+                if root == self.manifest_root:
+                    self._update(manifest, priority)
+                else:
+                    self._rebuild(root, manifest, priority)
+            except IndexSuperseded:
+                self.logger.info('Indexing of %s superseded', root)
+                self.stats.Count('index_superseded')
+                return False
+            finally:
+                self.target = self.store
+                self.pass_generation = None
+                self.progress = None
+                with self.generation_lock:
+                    if self.pass_root == (generation, root):
+                        self.pass_root = None
+        self.Watch(root)
+        return True
+
+    def Indexing(self, root):
+        """Whether a pass over root is in progress and was not superseded."""
+        with self.generation_lock:
+            return self.pass_root == (self.generation, root)
+
+    def _rebuild(self, root, manifest, priority):
+        if self.store.files:
+            self.target = SymbolStore()
+        sources = sorted(manifest)
+        self.harvest = HeaderHarvest(
+            [filename for filename in sources if is_header(filename)])
+        self.includers = {}
+        if self.cache_dir:
+            sources = self._load_cache(root, sources, manifest)
+        sources = prioritize(sources, priority)
+        self.progress = [0, len(sources)]
+        # No point in keeping translation units around for a full pass
+        self._index(sources, incremental=False)
+        with self.view_lock:
+            self.store = self.target
+        self.manifest = manifest
+        self.manifest_root = root
+        if self.journal:
+            self.journal.Compact()
+
+    def _update(self, manifest, priority):
+        added, changed, removed = diff_manifest(self.manifest, manifest)
+        self.logger.info('%d file(s) added, %d changed and %d removed since '
+                         'the last pass', len(added), len(changed), len(removed))
+        self.stats.Count('files_unchanged',
+                         len(manifest) - len(added) - len(changed))
+        if removed:
+            self.Remove(removed)
+        files = prioritize(sorted(added + changed), priority)
+        self.progress = [0, len(files)]
+        if files:
+            self._index(files)
+
+    def Supersede(self):
+        """Stops the pass over a directory in progress, if any."""
+        with self.generation_lock:
+            self.generation += 1
+
+    def _check_superseded(self):
+        if (self.pass_generation is not None and
+                self.pass_generation != self.generation):
+            raise IndexSuperseded()
+
+    def Progress(self):
+        """Returns the number of files indexed and to index by the pass over
+        a directory in progress, or None."""
+        progress = self.progress
+        if progress is None:
+            return None
+        return {'done': progress[0], 'total': progress[1]}
+
+    def _load_cache(self, root, sources, manifest):
+        """Loads records of unchanged files from the cache and returns the
+        files which still need to be parsed. manifest maps sources to their
+        current (mtime, size)."""
+        t0 = time.time()
+        if self.cache:
+            self.cache.Close()
+        self.cache = IndexCache(
+            IndexCache.path_for(self.cache_dir, root), self.logger)
+        entries = self.cache.Load()
+        stale = []
+        touched = []
+        loaded = []
+        for filename in sources:
+            entry = entries.pop(filename, None)
+            if entry is None:
+                stale.append(filename)
+                continue
+            mtime, size, digest, rows = entry
+            current_mtime, current_size = manifest[filename]
+            if current_size != size:
+                stale.append(filename)
+                continue
+            if current_mtime != mtime:
+                # Touched but maybe not modified, compare the content
+                try:
+                    current_digest = file_state(filename)[2]
+                except (IOError, OSError):
+                    current_digest = None
+                if current_digest != digest:
+                    stale.append(filename)
+                    continue
+                touched.append((filename, current_mtime))
+            if filename in self.harvest.candidates:
+                self.harvest.known[filename] = (current_mtime, size, digest)
+            loaded.append((filename, rows))
+        self._load(loaded)
+        self.cache.Touch(touched)
+        # Whatever is left is gone from the disk
+        self.cache.Remove(list(entries))
+        t1 = time.time()
+        self.stats.Time('cache_load', t1 - t0)
+        self.stats.Count('files_from_cache', len(sources) - len(stale))
+        self.logger.info('Loaded %d file(s) from cache %s in %0.3f ms, %d file(s) to parse',
+                         len(sources) - len(stale), self.cache.path,
+                         (t1 - t0) * 1000.0, len(stale))
+        return stale
 
     def Index(self, files=[], root=None):
+        with self.Changing():
+            self._index(files)
+        if root:
+            self.Watch(root)
+        # Clean up after ourself
+        self.index_thread = None
+
+    def _index(self, files, incremental=True):
         self.logger.info('Indexing %d file(s)...',  len(files))
         t0 = time.time()
+        parsed = []
+        self.collected = set()
+        headers = []
+        units = files
+        if self.harvest_headers:
+            headers = [filename for filename in files if is_header(filename)]
+            units = [filename for filename in files if not is_header(filename)]
+            self.harvest.candidates.update(headers)
+            for header in headers:
+                self.harvest.known.pop(header, None)
+            if incremental:
+                headers = [header for header in headers
+                           if not self._refresh_header(header, parsed)]
+        try:
+            self._parse(units, parsed, incremental)
+            # Headers no translation unit included are parsed on their own
+            headers = [header for header in headers
+                       if header not in self.harvest.known]
+            if headers:
+                self.stats.Count('headers_standalone', len(headers))
+                self._parse(headers, parsed, incremental)
+        except IndexSuperseded:
+            # Still valid for the next pass
+            if self.cache:
+                self.cache.Store(parsed)
+            raise
+        t1 = time.time()
+        self.stats.Time('index', t1 - t0)
+
+        self.logger.info('Done indexing %d file(s) %d function(s) %d type(s) in %0.3f ms...', len(
+            files), len(self.store.functions), len(self.store.types), (t1 - t0) * 1000.0)
+
+        if self.cache:
+            self.cache.Store(parsed)
+
+        if incremental:
+            # A full pass sets the manifest once complete
+            for filename, mtime, size, digest, records in parsed:
+                self.manifest[filename] = (mtime, size)
+            if self.journal:
+                self.journal.Update(
+                    [(filename, records) for filename, mtime, size, digest, records in parsed])
+        self.stats.Time('write', time.time() - t1)
+
+    def _parse(self, files, parsed, incremental):
+        if (self.jobs > 1 and len(files) > 1 and
+                not (incremental and len(files) < SERIAL_BATCH)):
+            self._index_parallel(files, parsed)
+            return
+        harvest = self.harvest if self.harvest_headers else None
         for filename in files:
+            self._check_superseded()
             self.logger.debug('Parsing %s', filename)
+            timings = {}
             try:
-                # Get AST from Clang
-                tu = self.cindex.parse(filename, self.includes)
-                # Make sure to first remove any information that were
-                # previously in this file
-                for k in self.functions:
-                    fn = self.functions[k]
-                    decl = fn['FUNCTION_DECL']
-                    impl = fn['FUNCTION_IMPL']
-                    calls = fn['CALL_EXPR']
-                    if (decl and decl['file'] == filename):
-                        self.logger.debug(
-                            'Removing function %s declaration from %s', k, filename)
-                        del self.functions[k]['FUNCTION_DECL']
-                    if (impl and impl['file'] == filename):
-                        self.logger.debug(
-                            'Removing function %s implementation from %s', k, filename)
-                        del self.functions[k]['FUNCTION_IMPL']
-                    for idx, call in enumerate(calls):
-                        if call['file'] == filename:
-                            self.logger.debug(
-                                'Removing function %s call from %s', k, filename)
-                            del self.functions[k]['CALL_EXPR'][idx]
-                # Fill internal structure
-                content = list()
-                with open(filename) as f:
-                    content = f.readlines()
-
-                self.logger.debug("Loaded %d lines for %s",
-                                  len(content), filename)
-                self._parse(tu.cursor, filename, content)
-            except clang.cindex.TranslationUnitLoadError:
+                records, state = parse_file(
+                    self.cindex, filename, self.includes,
+                    self.units if incremental else None,
+                    bool(self.cache_dir), timings, harvest)
+                self._parsed(filename, timings)
+                self._add(filename, records, state, parsed)
+                if harvest:
+                    self._harvested(filename, harvest.Take(), parsed)
+            except (clang.cindex.TranslationUnitLoadError, IOError, OSError):
                 self.logger.warning('Failed ot parse %s', filename)
-        t1 = time.time()
+                self._parsed(filename, timings, False)
 
-        self.logger.info('Done indexing %d file(s) %d function(s) %d type(s) in %0.3f ms...', len(
-            files), len(self.functions), len(self.types), (t1 - t0) * 1000.0)
-
-        if self.index_file:
-            self.logger.info('Saving index into %s', self.index_file)
-            with open(self.index_file, 'w') as output:
-                for function in self.functions:
-                    defined = False
-                    if 'file' in self.functions[function]['FUNCTION_DECL']:
-                        output.write("DECL %s (%s:%d)\n" % (function, self.functions[function][
-                                     'FUNCTION_DECL']['file'], self.functions[function]['FUNCTION_DECL']['line']))
-                        defined = True
-                    if 'file' in self.functions[function]['FUNCTION_IMPL']:
-                        output.write("IMPL %s (%s:%d)\n" % (function, self.functions[function][
-                                     'FUNCTION_IMPL']['file'], self.functions[function]['FUNCTION_IMPL']['line']))
-                        defined = True
-                    if defined:
-                        for call in self.functions[function]['CALL_EXPR']:
-                            output.write("CALL %s (%s:%d)\n" %
-                                         (function, call['file'], call['line']))
-                for tpe in self.types:
-                    if 'file' in self.types[tpe]['TYPE_DECL']:
-                        output.write("TYPE %s (%s:%d)\n" % (function, self.types[tpe][
-                                     'TYPE_DECL']['file'], self.types[tpe]['TYPE_DECL']['line']))
-                        for call in self.types[tpe]['TYPE_REF']:
-                            output.write("REF %s (%s:%d)\n" %
-                                         (function, call['file'], call['line']))
-        if root:
-            # Attempt to watch changes if monitor is available
-            try:
-                from watchdog.observers import Observer
-                from watchdog.events import FileSystemEventHandler
-
-                class EventHandler(FileSystemEventHandler):
-
-                    def __init__(self, indexer):
-                        self.indexer = indexer
-
-                    def on_deleted(self, event):
-                        # That one is tricky, we technically need to clean up
-                        # files deleted from the internal structures
-                        return
-
-                    def on_modified(self, event):
-                        if not event.is_directory:
-                            self.indexer.Index([event.src_path])
-
-                    def on_created(self, event):
-                        if not event.is_directory:
-                            self.indexer.Index([event.src_path])
-                        else:
-                            sources = Indexer.find_source_files(
-                                event.src_path)
-                            self.indexer.Index(sources)
-
-                self.logger.info('Watching changes under %s', root)
-                if self.observer:
-                    self.observer.stop()
-                handler = EventHandler(self)
-                self.observer = Observer()
-                self.observer.schedule(handler, root, recursive=True)
-                self.observer.start()
-            except ImportError:
-                self.logger.warning('File monitor not available')
-        # Clean up after ourself
-        self.index_thread = None
+    def _add(self, filename, records, state, parsed):
+        self._merge(filename, records)
+        parsed.append((filename,) + state + (records,))
+        if filename in self.harvest.candidates:
+            self.harvest.known[filename] = state
 
-    def Autocomplete(self, lookup):
-        matches = set()
-        matches |= set(
-            [k for k, v in self.functions.items() if k.startswith(lookup)])
-        matches |= set(
-            [k for k, v in self.types.items() if k.startswith(lookup)])
-        return matches
+    def _harvested(self, includer, harvested, parsed):
+        """Merges the records of headers collected while parsing includer.
+        Workers may collect the same header, only the first one is kept."""
+        for header, records, state in harvested:
+            if header in self.collected:
+                continue
+            self.collected.add(header)
+            self.includers[header] = includer
+            self._add(header, records, state, parsed)
+            self.stats.Count('headers_harvested')
+            if self.progress:
+                self.progress[0] += 1
 
-    def Implementation(self, lookup):
-        impl = None
-        if lookup in self.functions:
-            if 'file' in self.functions[lookup]['FUNCTION_IMPL']:
-                impl = self.functions[
-                    lookup]['FUNCTION_IMPL']
-        return impl
+    def _refresh_header(self, header, parsed):
+        """Collects the records of a modified header from the translation
+        unit they were first collected from, leaving the records of that
+        unit alone."""
+        includer = self.includers.get(header)
+        if not includer or not os.path.isfile(includer):
+            return False
+        self.logger.debug('Parsing %s through %s', header, includer)
+        timings = {}
+        try:
+            t0 = time.time()
+            state = file_state(header)
+            t1 = time.time()
+            tu = self.units.Parse(includer)
+            t2 = time.time()
+            spellings = [inclusion.include.name for inclusion in tu.get_includes()
+                         if os.path.normpath(inclusion.include.name) == header]
+            if not spellings:
+                return False
+            records = extract_records(tu.cursor, spellings[0], timings)
+            timings.update(read=t1 - t0, parse=t2 - t1, walk=time.time() - t2)
+        except (clang.cindex.TranslationUnitLoadError, IOError, OSError):
+            return False
+        self._parsed(header, timings)
+        self._add(header, records, state, parsed)
+        self.stats.Count('headers_refreshed')
+        return True
 
-    def Declaration(self, lookup):
-        decl = None
-        if lookup in self.functions:
-            if 'file' in self.functions[lookup]['FUNCTION_DECL']:
-                decl = self.functions[
-                    lookup]['FUNCTION_DECL']
-            elif 'file' in self.functions[lookup]['FUNCTION_IMPL']:
-                decl = self.functions[
-                    lookup]['FUNCTION_IMPL']
-        elif lookup in self.types:
-            if 'file' in self.types[lookup]['TYPE_DECL']:
-                decl = self.types[lookup]['TYPE_DECL']
-        return decl
-
-    def Calls(self, lookup):
-        calls = None
-        if lookup in self.functions:
-            if 'file' in self.functions[lookup]['FUNCTION_IMPL']:
-                calls = self.functions[lookup]['CALL_EXPR']
-        elif lookup in self.types:
-            if 'file' in self.types[lookup]['TYPE_DECL']:
-                calls = self.types[lookup]['TYPE_REF']
-        return calls
+    def _parsed(self, filename, timings, success=True):
+        """Accounts for the parsing of a file."""
+        if self.progress:
+            self.progress[0] += 1
+        self.stats.Timings(timings)
+        if success:
+            self.stats.Count('files_parsed')
+            self.stats.File(filename, timings.get('parse', 0) +
+                            timings.get('walk', 0))
+        else:
+            self.stats.Count('parse_failures')
 
-    def _init_func(self, func):
-        if not func in self.functions:
-            self.functions[func] = {'FUNCTION_IMPL': {},
-                                    'FUNCTION_DECL': {}, 'CALL_EXPR': []}
+    def IndexBuffer(self, filename, content):
+        """Index the content of an unsaved buffer in place of filename.
+        Returns True once indexed, False if it could not be and None if it
+        was queued: while another thread changes the index, such as a pass
+        over a directory, the latest content of each buffer waits for it to
+        be done rather than the caller."""
+        if os.path.splitext(filename)[1] not in SOURCE_EXTENSIONS:
+            return False
+        with self.buffers_lock:
+            self.buffers[filename] = content
+        indexed = self._index_buffers().get(filename)
+        if indexed is None:
+            self.stats.Count('buffers_queued')
+        return indexed
 
-    def _init_type(self, tpe):
-        if not tpe in self.types:
-            self.types[tpe] = {'TYPE_DECL': {}, 'TYPE_REF': []}
+    def _index_buffers(self):
+        """Indexes the queued buffers unless the lock is held, its holder
+        indexes them once done. Returns filename -> whether it was indexed
+        for the buffers indexed."""
+        indexed = {}
+        while self.buffers and self.lock.acquire(False):
+            try:
+                if self.changing:
+                    # Within a Changing() block of this very thread
+                    break
+                while True:
+                    with self.buffers_lock:
+                        if not self.buffers:
+                            break
+                        filename, content = self.buffers.popitem()
+                    indexed[filename] = self._index_buffer(filename, content)
+            finally:
+                self.lock.release()
+        return indexed
 
-    def _location_to_dict(self, location):
-            return {
-                'file': location.file.name,
-                'line': location.line,
-                'column': location.column,
-            }
+    def _index_buffer(self, filename, content):
+        self.logger.debug('Parsing buffer %s', filename)
+        t0 = time.time()
+        try:
+            tu = self.units.Parse(filename, [(filename, content)])
+        except clang.cindex.TranslationUnitLoadError:
+            self.logger.warning('Failed ot parse buffer %s', filename)
+            self.stats.Count('parse_failures')
+            return False
+        timings = {'parse': time.time() - t0}
+        records = extract_records(tu.cursor, filename, timings)
+        timings['walk'] = time.time() - t0 - timings['parse']
+        self.stats.Timings(timings)
+        self.stats.Count('buffers_indexed')
+        # Not written to the cache, the file on disk did not change. It is
+        # parsed again by the next pass in case the buffer is dropped
+        self._merge(filename, records)
+        self.manifest.pop(filename, None)
+        self.snippets.SetBuffer(filename, content)
+        return True
 
-    def _add_func(self, node):
-        self._init_func(node.spelling)
-        if os.path.splitext(node.location.file.name)[1] in ['.c', '.cpp']:
-            self.functions[node.spelling][
-                'FUNCTION_IMPL'] = self._location_to_dict(node.location)
+    def Watch(self, root):
+        # Attempt to watch changes if monitor is available
+        try:
+            from cindex.watcher import Watcher
+            self.logger.info('Watching changes under %s', root)
+            if self.watcher:
+                self.watcher.Stop()
+            self.watcher = Watcher(self, self.logger, root, self.finder)
+        except ImportError:
+            self.logger.warning('File monitor not available')
+
+    def QueueDepth(self):
+        """Number of changed files waiting to be reindexed."""
+        if self.watcher:
+            return self.watcher.queue.Depth()
+        return 0
+
+    def _index_parallel(self, files, parsed):
+        """Parse files in a pool of worker processes and merge the records
+        they send back as they arrive."""
+        self.logger.info('Using %d worker(s)', self.jobs)
+        # Vim embeds the server, make sure workers are forked and not spawned
+        # from the vim executable.
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
         else:
-            self.functions[node.spelling][
-                'FUNCTION_DECL'] = self._location_to_dict(node.location)
-
-    def _add_type(self, node):
-        self._init_type(node.spelling)
-        self.types[node.spelling][
-            'TYPE_DECL'] = self._location_to_dict(node.location)
-
-    def _add_call(self, node, content):
-        self._init_func(node.spelling)
-        dct = self._location_to_dict(node.location)
-        dct['content'] = content.rstrip()
-        self.functions[node.spelling]['CALL_EXPR'].append(dct)
-
-    def _add_ref(self, node, content):
-        self._init_type(node.spelling)
-        dct = self._location_to_dict(node.location)
-        dct['content'] = content.rstrip()
-        self.types[node.spelling]['TYPE_REF'].append(dct)
-
-    def _parse(self, node, filename, content, depth = 0):
+            context = multiprocessing
+        headers = ()
+        if self.harvest_headers:
+            headers = self.harvest.candidates
+        # Set once superseded so that workers skip the remaining files,
+        # terminating the pool may deadlock
+        cancelled = context.Value('b', 0, lock=False)
+        pool = context.Pool(self.jobs, _worker_init,
+                            (self.includes, bool(self.cache_dir), headers,
+                             self.harvest.known, cancelled))
         try:
-            self.logger.debug('%s| %s %s %d', ' ' * depth, node.kind,
-                              node.spelling, node.location.line)
-            if (node.location.file and node.location.file.name == filename):
-                if (node.kind == clang.cindex.CursorKind.FUNCTION_DECL):
-                    self.logger.debug('FUNCTION_DECL:%s:%s:%d', node.spelling,
-                                      node.location.file.name, node.location.line)
-                    self._add_func(node)
-                elif (node.kind == clang.cindex.CursorKind.TYPEDEF_DECL):
-                    self.logger.debug(
-                        '%s   TYPE_DECL:%s:%s:%d', ' ' * depth, node.spelling, node.location.file.name, node.location.line)
-                    self._add_type(node)
-                elif (node.kind == clang.cindex.CursorKind.CALL_EXPR):
-                    self.logger.debug(
-                        '%s   CALL:%s:%s: %d', ' ' * depth, node.spelling, node.location.file.name, node.location.line)
-                    self._add_call(node, content[node.location.line - 1])
-                elif (node.kind == clang.cindex.CursorKind.TYPE_REF):
-                    self.logger.debug(
-                        '%s   TYPE_REF:%s:%s:%d', ' ' * depth, node.spelling, node.location.file.name, node.location.line)
-                    self._add_ref(node, content[node.location.line - 1])
-        except ValueError:
-            # Incompatible libclang and pyclang?
-            self.logger.warning("%s  Ignoring node %s %s %d", ' ' * depth, node.spelling,
-                                node.location.file.name, node.location.line)
+            chunksize = max(1, min(16, len(files) // (self.jobs * 4)))
+            # The first files, the prioritized ones, are sent on their own
+            # so that their records do not wait for the rest of a chunk
+            head = self.jobs
+            results = itertools.chain(
+                pool.imap_unordered(_worker_parse, files[:head]),
+                pool.imap_unordered(_worker_parse, files[head:], chunksize))
+            for filename, records, state, timings, harvested in results:
+                self._check_superseded()
+                if records is None:
+                    self.logger.warning('Failed ot parse %s', filename)
+                    self._parsed(filename, timings, False)
+                else:
+                    self._parsed(filename, timings)
+                    self._add(filename, records, state, parsed)
+                    self._harvested(filename, harvested, parsed)
+        except IndexSuperseded:
+            cancelled.value = 1
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+    def Remove(self, files=[]):
+        """Forget everything the given files contributed to the index."""
+        self.logger.info('Removing %d file(s)...', len(files))
+        self.stats.Count('files_removed', len(files))
+        with self.Changing():
+            for filename in files:
+                self.units.Remove(filename)
+                self.harvest.candidates.discard(filename)
+                self.harvest.known.pop(filename, None)
+                self.includers.pop(filename, None)
+                self.manifest.pop(filename, None)
+                with self.view_lock:
+                    self._remove_file(filename)
+            if self.cache:
+                self.cache.Remove(files)
+            if self.journal:
+                self.journal.Update(removed=files)
+
+    def _remove_file(self, filename):
+        self.snippets.Invalidate(filename)
+        t0 = time.time()
+        if self.target.RemoveFile(filename):
+            self.logger.debug('Removed %s', filename)
+        self.stats.Time('remove', time.time() - t0)
+
+    def _load(self, entries, chunk=256):
+        """Adds a list of (filename, rows) loaded from the cache, a chunk of
+        files at a time so that queries are not held for long."""
+        t0 = time.time()
+        for i in range(0, len(entries), chunk):
+            for filename, rows in entries[i:i + chunk]:
+                self.snippets.Invalidate(filename)
+            with self.view_lock:
+                self.target.Load(entries[i:i + chunk])
+        self.stats.Time('merge', time.time() - t0, len(entries))
+
+    def _merge(self, filename, records):
+        self.snippets.Invalidate(filename)
+        with self.view_lock:
+            t0 = time.time()
+            # Timed apart from the merge itself, Merge has nothing left to
+            # remove afterwards
+            self.target.RemoveFile(filename)
+            t1 = time.time()
+            self.target.Merge(filename, records)
+            t2 = time.time()
+        self.stats.Time('remove', t1 - t0)
+        self.stats.Time('merge', t2 - t1)
+        self.stats.Count('records', len(records))
+
+    def Stats(self):
+        """Counters and timers of the indexer along with the size of the
+        index."""
+        stats = self.stats.ToDict()
+        with self.view_lock:
+            stats['index'] = {
+                'files': len(self.store.files),
+                'functions': len(self.store.functions),
+                'types': len(self.store.types),
+                'call_edges': sum(len(callees) for callees in
+                                  self.store.callees.values()),
+            }
+        stats['index']['translation_units'] = len(self.units)
+        stats['index']['translation_units_memory'] = self.units.memory
+        stats['queue'] = self.QueueDepth()
+        stats['progress'] = self.Progress()
+        return stats
+
+    def Files(self):
+        """Files currently in the index."""
+        with self.view_lock:
+            return self.store.Files()
+
+    def _snapshot(self):
+        # One file at a time so that queries are not held for long, the
+        # changes made meanwhile are written by the journal afterwards
+        with self.view_lock:
+            store = self.store
+            files = store.Files()
+        entries = []
+        for filename in files:
+            with self.view_lock:
+                if store.HasFile(filename):
+                    entries.append((filename, store.Records(filename)))
+        return entries
+
+    def Autocomplete(self, lookup, limit=None, offset=0):
+        return self.store.prefix.Lookup(lookup, limit, offset)
+
+    def Find(self, pattern, limit=None, offset=0):
+        # Ranked, earlier pages have to be looked up again
+        return self.store.trigrams.Find(pattern, offset + (limit or 50))[offset:]
+
+    def Implementation(self, lookup):
+        with self.view_lock:
+            return self.store.Implementation(lookup)
+
+    def Declaration(self, lookup):
+        with self.view_lock:
+            return self.store.Declaration(lookup)
+
+    def Calls(self, lookup, limit=None, offset=0):
+        with self.view_lock:
+            calls = self.store.Calls(lookup, offset, limit)
+        # Only the lines of the calls returned are read
+        if calls:
+            self.snippets.Fill(calls)
+        return calls
 
-        # Recurse on children
-        for c in node.get_children():
-            #self.logger.debug('%s++ %s %s', ' ' * depth, c.kind, c.spelling)
-            self._parse(c, filename, content, depth + 1)
+    def Callers(self, lookup, depth=1, limit=None, offset=0):
+        with self.view_lock:
+            return self.store.Callers(lookup, depth,
+                                      offset + (limit or 1000))[offset:]
 
+    def Callees(self, lookup, depth=1, limit=None, offset=0):
+        with self.view_lock:
+            return self.store.Callees(lookup, depth,
+                                      offset + (limit or 1000))[offset:]
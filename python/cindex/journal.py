@@ -0,0 +1,124 @@
+import os
+import threading
+
+# Rows written for each kind of record
+ROW_FORMAT = "%s %s (%s:%d)\n"
+
+
+class IndexJournal(object):
+    """Append only export of the index.
+
+    Every update appends the records of the files it touched:
+        FILE + <path>
+        DECL <name> (<path>:<line>)
+        ...
+    or a removal marker:
+        FILE - <path>
+    so that its cost is proportional to the change. Once the journal grows
+    over max_size and over twice its size after the last compaction, it is
+    compacted in the background into a snapshot of the current records,
+    which atomically replaces it. A reader replaying the
+    journal always ends up with a consistent view of the index."""
+
+    def __init__(self, path, logger, snapshot, max_size=16 * 1024 * 1024):
+        self.path = path
+        self.logger = logger
+        # Returns a list of (path, records) of the whole index
+        self.snapshot = snapshot
+        self.max_size = max_size
+        # Size of the journal right after the last compaction, the snapshot
+        # of a large index alone may be over max_size
+        self.compacted_size = 0
+        self.lock = threading.Lock()
+        self.output = open(path, 'a')
+        # Updates made while compacting, written after the snapshot
+        self.backlog = None
+        # Compact was called while compacting, the index may have been
+        # replaced since the snapshot was taken
+        self.compact_again = False
+
+    @staticmethod
+    def _format(changed, removed):
+        rows = []
+        for filename in removed:
+            rows.append("FILE - %s\n" % filename)
+        for filename, records in changed:
+            rows.append("FILE + %s\n" % filename)
+            for kind, name, line, column, caller in records:
+                rows.append(ROW_FORMAT % (kind, name, filename, line))
+        return ''.join(rows)
+
+    def Update(self, changed=[], removed=[]):
+        """Appends a list of (path, records) and a list of removed paths."""
+        if not changed and not removed:
+            return
+        text = self._format(changed, removed)
+        with self.lock:
+            self.output.write(text)
+            self.output.flush()
+            if self.backlog is not None:
+                self.backlog.append(text)
+            elif self._size() > max(self.max_size, 2 * self.compacted_size):
+                self._start_compaction()
+
+    def _size(self):
+        return os.fstat(self.output.fileno()).st_size
+
+    def Compact(self):
+        """Rewrites the journal from the current index in the background."""
+        with self.lock:
+            if self.backlog is None:
+                self._start_compaction()
+            else:
+                self.compact_again = True
+
+    def _start_compaction(self):
+        self.backlog = []
+        thread = threading.Thread(target=self._compact)
+        thread.daemon = True
+        thread.start()
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            entries = self.snapshot()
+            with open(tmp_path, 'w') as output:
+                output.write(self._format(entries, []))
+            with self.lock:
+                with open(tmp_path, 'a') as output:
+                    output.write(''.join(self.backlog))
+                os.rename(tmp_path, self.path)
+                self.output.close()
+                self.output = open(self.path, 'a')
+                self.compacted_size = self._size()
+                self.logger.info('Compacted %s to %d bytes',
+                                 self.path, self.compacted_size)
+        except (IOError, OSError) as er:
+            self.logger.warning('Failed to compact %s: %s', self.path, er)
+        finally:
+            with self.lock:
+                self.backlog = None
+                if self.compact_again:
+                    self.compact_again = False
+                    self._start_compaction()
+
+    def Close(self):
+        with self.lock:
+            self.output.close()
+
+    @staticmethod
+    def Load(path):
+        """Replays a journal and returns a dict of path -> list of rows."""
+        files = {}
+        current = None
+        with open(path) as f:
+            for line in f:
+                if line.startswith('FILE + '):
+                    current = []
+                    files[line[7:].rstrip('\n')] = current
+                elif line.startswith('FILE - '):
+                    files.pop(line[7:].rstrip('\n'), None)
+                    current = None
+                elif current is not None:
+                    current.append(line.rstrip('\n'))
+        return files
@@ -0,0 +1,121 @@
+import bisect
+import threading
+
+# Number of names per chunk, chunks hold up to twice as many before being
+# split
+CHUNK_SIZE = 1024
+
+
+class PrefixIndex(object):
+    """Sorted symbol names answering prefix lookups with bisect.
+
+    Names are kept in sorted chunks along with the last name of each chunk,
+    so that adding or removing a name only moves the names of its chunk.
+    Changes are applied as they come, lookups only read."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = []
+        # Last name of each chunk
+        self.maxes = []
+        self.members = set()
+
+    def __len__(self):
+        return len(self.members)
+
+    def Add(self, name):
+        self.AddMany([name])
+
+    def AddMany(self, names):
+        with self.lock:
+            added = sorted(set(name for name in names
+                               if name not in self.members))
+            if not added:
+                return
+            if len(added) > max(CHUNK_SIZE, len(self.members) // 8):
+                # Sorting two sorted runs is a linear merge, cheaper than
+                # inserting that many names one by one
+                merged = [name for chunk in self.chunks for name in chunk]
+                merged.extend(added)
+                merged.sort()
+                self.chunks = [merged[i:i + CHUNK_SIZE]
+                               for i in range(0, len(merged), CHUNK_SIZE)]
+                self.maxes = [chunk[-1] for chunk in self.chunks]
+            else:
+                for name in added:
+                    self._insert(name)
+            self.members.update(added)
+
+    def _insert(self, name):
+        if not self.chunks:
+            self.chunks.append([name])
+            self.maxes.append(name)
+            return
+        idx = bisect.bisect_left(self.maxes, name)
+        if idx == len(self.maxes):
+            idx -= 1
+            self.chunks[idx].append(name)
+            self.maxes[idx] = name
+        else:
+            bisect.insort(self.chunks[idx], name)
+        if len(self.chunks[idx]) > 2 * CHUNK_SIZE:
+            self._split(idx)
+
+    def _split(self, idx):
+        chunk = self.chunks[idx]
+        half = len(chunk) // 2
+        self.chunks[idx:idx + 1] = [chunk[:half], chunk[half:]]
+        self.maxes[idx:idx + 1] = [chunk[half - 1], chunk[-1]]
+
+    def Remove(self, name):
+        self.RemoveMany([name])
+
+    def RemoveMany(self, names):
+        with self.lock:
+            for name in names:
+                if name not in self.members:
+                    continue
+                self.members.discard(name)
+                idx = bisect.bisect_left(self.maxes, name)
+                chunk = self.chunks[idx]
+                del chunk[bisect.bisect_left(chunk, name)]
+                if chunk:
+                    self.maxes[idx] = chunk[-1]
+                if len(chunk) < CHUNK_SIZE // 4 and len(self.chunks) > 1:
+                    # Merged with the next one, or the previous one for the
+                    # last chunk, so that chunks do not dwindle
+                    if idx == len(self.chunks) - 1:
+                        idx -= 1
+                    merged = self.chunks[idx] + self.chunks[idx + 1]
+                    self.chunks[idx:idx + 2] = [merged]
+                    self.maxes[idx:idx + 2] = [merged[-1]]
+                    if len(merged) > 2 * CHUNK_SIZE:
+                        self._split(idx)
+                elif not chunk:
+                    del self.chunks[idx]
+                    del self.maxes[idx]
+
+    def Lookup(self, prefix, limit=None, offset=0):
+        """Returns names starting with prefix in sorted order, an exact match
+        coming first, up to limit names after the first offset ones."""
+        with self.lock:
+            chunks = self.chunks
+            matches = []
+            idx = bisect.bisect_left(self.maxes, prefix)
+            if idx == len(chunks):
+                return matches
+            position = bisect.bisect_left(chunks[idx], prefix) + offset
+            while idx < len(chunks):
+                chunk = chunks[idx]
+                if position >= len(chunk):
+                    position -= len(chunk)
+                    idx += 1
+                    continue
+                name = chunk[position]
+                if not name.startswith(prefix):
+                    break
+                if limit is not None and len(matches) >= limit:
+                    break
+                matches.append(name)
+                position += 1
+            return matches
@@ -1,47 +1,156 @@
 #!/usr/bin/env python
 import argparse
+import json
+import os
 import sys
 import socket
+import threading
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIR_OF_CURRENT_SCRIPT, ".."))
+from cindex import daemon
 
 
 class Searcher(object):
 
-    def __init__(self, port, debug = False):
+    def __init__(self, port = None, debug = False, persistent = False,
+                 path = None):
         self.port = port
+        # Unix domain socket of a daemon, used instead of port when given
+        self.path = path
         self.debug = debug
+        # Keep the connection open between commands
+        self.persistent = persistent
+        # Command sent first on every new connection, such as ATTACH
+        self.greeting = None
+        self.sock = None
+        self.buffer = ''
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def _readline(self, sock):
+        while "\n" not in self.buffer:
+            data = sock.recv(4096)
+            if not data:
+                raise socket.error("Connection closed")
+            self.buffer += data
+        line, self.buffer = self.buffer.split("\n", 1)
+        if self.debug:
+            print >>sys.stderr, " <- %s" % line
+        return line
 
-    def _gets(self, socket):
+    def _gets(self, sock):
         lines = []
         while True:
-            data = socket.recv(4096)
-            tmp = data.split("\n")
-            del tmp[-1]
-            if self.debug:
-                for line in tmp:
-                    print >>sys.stderr, " <- %s\n" % line
-            lines = lines + tmp
-            if "DONE" in tmp:
-                del lines[-1]
+            line = self._readline(sock)
+            if line == "DONE":
                 return lines
+            lines.append(line)
 
-    def _command(self, message):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_address = ('localhost', int(self.port))
-        if self.debug:
-            print >>sys.stderr, "Connecting to %s" % self.port
-        try:
-            sock.connect(server_address)
+    def _get_replies(self, sock, request_id, count):
+        replies = [None] * count
+        while True:
+            reply = json.loads(self._readline(sock))
+            # Errors about requests the server could not even parse have no id
+            if 'error' in reply and reply.get('id') in (request_id, None):
+                raise ValueError(reply['error'])
+            if reply.get('id') != request_id:
+                continue
+            if reply.get('done'):
+                return replies
+            replies[reply['seq']] = reply['results']
+
+    def _get_json(self, sock):
+        """Returns the reply lines of a JSON request sent as is, up to the
+        one ending it."""
+        lines = []
+        while True:
+            line = self._readline(sock)
+            reply = json.loads(line)
+            if 'error' in reply:
+                raise ValueError(reply['error'])
+            lines.append(line)
+            if reply.get('done'):
+                return lines
+
+    def _connect(self):
+        if self.path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             if self.debug:
-                print >>sys.stderr, " -> %s" % message
-            sock.sendall(message)
-            return self._gets(sock)
-        except Exception as er:
+                print >>sys.stderr, "Connecting to %s" % self.path
+            sock.connect(self.path)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_address = ('localhost', int(self.port))
             if self.debug:
-                print >>sys.stderr, "Failed to connect", er
+                print >>sys.stderr, "Connecting to %s" % self.port
+            sock.connect(server_address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = ''
+        if self.greeting:
+            sock.sendall(self.greeting)
+            self._gets(sock)
+        return sock
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def abort(self):
+        """Makes a command in progress in another thread fail right away."""
+        sock = self.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _command(self, message, reader=None):
+        with self.lock:
+            # A persistent connection may have been closed by the server in
+            # the meantime, give it another try on a fresh one
+            attempts = 2 if self.persistent and self.sock else 1
+            for attempt in range(attempts):
+                try:
+                    if not self.sock:
+                        self.sock = self._connect()
+                    if self.debug:
+                        print >>sys.stderr, " -> %s" % message.rstrip()
+                    self.sock.sendall(message)
+                    if reader:
+                        return reader(self.sock)
+                    return self._gets(self.sock)
+                except Exception as er:
+                    if self.debug:
+                        print >>sys.stderr, "Failed to connect", er
+                    self._close()
+                finally:
+                    if not self.persistent:
+                        self._close()
             return None
-        finally:
-            sock.close()
 
+    def command(self, line):
+        """Sends a raw command line such as "IMPL main", or a JSON request
+        whose reply lines are not followed by DONE."""
+        if line.startswith('{'):
+            return self._command(line.rstrip("\n") + "\n", self._get_json)
+        return self._command(line.rstrip("\n") + "\n")
+
+    def batch(self, queries):
+        """Sends a list of {"cmd": ..., "arg": ...} queries in a single round
+        trip and returns the list of results of each of them."""
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+        message = json.dumps({'v': 2, 'id': request_id,
+                              'queries': queries}) + "\n"
+        return self._command(message, lambda sock: self._get_replies(
+            sock, request_id, len(queries)))
 
     def index(self, path):
         message = "INDEX %s\n" % path
@@ -55,14 +164,63 @@ class Searcher(object):
         message = "DECL %s\n" % pattern
         return self._command(message)
 
-    def calls(self, pattern):
-        message = "CALLS %s\n" % pattern
+    def calls(self, pattern, limit=None, offset=None):
+        """With limit, answers a page of calls which ends with a "NEXT
+        <offset>" line when there are more."""
+        if limit:
+            message = "CALLS %s LIMIT %d OFFSET %d\n" % (
+                pattern, int(limit), int(offset or 0))
+        else:
+            message = "CALLS %s\n" % pattern
+        return self._command(message)
+
+    def callers(self, pattern, depth=None):
+        if depth:
+            message = "CALLERS %s %d\n" % (pattern, int(depth))
+        else:
+            message = "CALLERS %s\n" % pattern
+        return self._command(message)
+
+    def callees(self, pattern, depth=None):
+        if depth:
+            message = "CALLEES %s %d\n" % (pattern, int(depth))
+        else:
+            message = "CALLEES %s\n" % pattern
         return self._command(message)
 
-    def complete(self, pattern):
-        message = "AUTO %s\n" % pattern
+    def complete(self, pattern, limit=None):
+        if limit:
+            message = "AUTO %s %d\n" % (pattern, int(limit))
+        else:
+            message = "AUTO %s\n" % pattern
         return self._command(message)
 
+    def find(self, pattern, limit=None):
+        if limit:
+            message = "FIND %s %d\n" % (pattern, int(limit))
+        else:
+            message = "FIND %s\n" % pattern
+        return self._command(message)
+
+    def progress(self):
+        """Returns the progress of the indexing in progress as a dict, or
+        None if there is none or the server is unreachable."""
+        lines = self._command("PROGRESS\n")
+        if not lines:
+            return None
+        return json.loads(lines[0])
+
+    def queue(self):
+        message = "QUEUE\n"
+        return self._command(message)
+
+    def stats(self):
+        """Returns the statistics of the server as a dict."""
+        lines = self._command("STATS\n")
+        if not lines:
+            return None
+        return json.loads(lines[0])
+
     def quit(self):
         message = "QUIT\n"
         return self._command(message)
@@ -71,16 +229,30 @@ class Searcher(object):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--port',
-                        default=10000,
-                        help='Listening port.')
+                        help='Listening port, 10000 by default unless a daemon '
+                        'serves the current project.')
+    parser.add_argument('--socket',
+                        help='Unix domain socket of a daemon.')
 
     args, unknown_args = parser.parse_known_args()
     argv = [sys.argv[0]] + unknown_args
 
-    searcher = Searcher(args.port)
+    path = args.socket
+    if not path and not args.port:
+        path = daemon.find_daemon(daemon.project_root(os.getcwd()))
+    searcher = Searcher(args.port or 10000, path=path)
 
     lines = None
-    if len(argv) == 3:
+    if len(argv) == 2:
+        if argv[1] == 'QUEUE':
+            lines = searcher.queue()
+        elif argv[1] == 'PROGRESS':
+            lines = searcher.command('PROGRESS')
+        elif argv[1] == 'STATS':
+            stats = searcher.stats()
+            if stats is not None:
+                lines = json.dumps(stats, indent=2, sort_keys=True).splitlines()
+    elif len(argv) == 3:
         if argv[1] == 'INDEX':
             lines = searcher.index(argv[2])
         elif argv[1] == 'IMPL':
@@ -89,8 +261,26 @@ def main():
             lines = searcher.declaration(argv[2])
         elif argv[1] == 'CALLS':
             lines = searcher.calls(argv[2])
+        elif argv[1] == 'CALLERS':
+            lines = searcher.callers(argv[2])
+        elif argv[1] == 'CALLEES':
+            lines = searcher.callees(argv[2])
         elif argv[1] == 'AUTO':
             lines = searcher.complete(argv[2])
+        elif argv[1] == 'FIND':
+            lines = searcher.find(argv[2])
+    elif len(argv) == 4:
+        if argv[1] == 'AUTO':
+            lines = searcher.complete(argv[2], argv[3])
+        elif argv[1] == 'FIND':
+            lines = searcher.find(argv[2], argv[3])
+        elif argv[1] == 'CALLERS':
+            lines = searcher.callers(argv[2], argv[3])
+        elif argv[1] == 'CALLEES':
+            lines = searcher.callees(argv[2], argv[3])
+    elif len(argv) > 4:
+        # Such as CALLS name LIMIT 100 OFFSET 200
+        lines = searcher.command(' '.join(argv[1:]))
 
     if lines is None:
         return 1
@@ -1,22 +1,86 @@
 #!/usr/bin/env python
 import argparse
+import json
 import logging
 import os
 import platform
 import re
+import select
 import socket
 import sys
 import threading
 import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.join(DIR_OF_CURRENT_SCRIPT, ".."))
+from cindex import daemon
 from cindex.indexer import Indexer
+from cindex.stats import CommandStats
+from cindex.storage import CallEntry, Location
+
+PROTOCOL_VERSION = 2
+
+# Commands with a latency histogram, anything else is accounted as OTHER
+COMMANDS = frozenset(['QUIT', 'INDEX', 'BUFFER', 'AUTO', 'FIND', 'QUEUE',
+                      'PROGRESS', 'IMPL', 'DECL', 'CALLS', 'CALLERS', 'CALLEES',
+                      'STATS', 'ATTACH', 'DETACH'])
+
+# Commands whose results may be partial while a directory is being indexed
+LOOKUPS = frozenset(['AUTO', 'FIND', 'IMPL', 'DECL', 'CALLS', 'CALLERS',
+                     'CALLEES'])
+
+# Deepest call hierarchy answered by CALLERS and CALLEES
+MAX_CALL_DEPTH = 16
+
+# Commands answering a list which can be fetched a page at a time
+PAGED = frozenset(['AUTO', 'FIND', 'CALLS', 'CALLERS', 'CALLEES'])
+
+
+class Client(object):
+    """A connected client and the bytes received but not handled yet."""
+
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.buffer = ''
+        # Whether the client keeps the daemon alive
+        self.attached = False
+
+    def fileno(self):
+        return self.connection.fileno()
+
+
+class ReplyWriter(object):
+    """Gathers the lines of a reply and sends them in chunks of about size
+    bytes rather than with a system call per line."""
+
+    def __init__(self, connection, size=64 * 1024):
+        self.connection = connection
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def Write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.Flush()
+
+    def Flush(self):
+        if self.parts:
+            self.connection.sendall(''.join(self.parts))
+            self.parts = []
+            self.length = 0
 
 
 class Server(object):
 
-    def __init__(self, index_file=None, log_file=None):
+    def __init__(self, index_file=None, log_file=None, jobs=1, cache_dir=None,
+                 threads=8, include=(), exclude=()):
         # Setup logging
         self.logger = logging.getLogger('vim.cindex')
         self.logger.setLevel(logging.DEBUG)
@@ -35,7 +99,23 @@ class Server(object):
             self.logger.addHandler(ch)
 
         self.index_thread = None
-        self.indexer = Indexer(index_file, self.logger)
+        self.server_thread = None
+        self.indexer = Indexer(index_file, self.logger, jobs, cache_dir,
+                               include=include, exclude=exclude)
+        # Latency of each command, from reception to the last byte sent
+        self.stats = CommandStats()
+        # Number of threads answering queries
+        self.threads = threads
+        self.running = False
+        self.returned = []
+        self.returned_lock = threading.Lock()
+        self.wakeup = None
+        # Number of attached clients, a daemon exits once there was none and
+        # no command for idle_timeout seconds
+        self.attached = 0
+        self.attached_lock = threading.Lock()
+        self.last_activity = time.time()
+        self.idle_timeout = None
 
     @staticmethod
     def get_unused_local_port():
@@ -57,87 +137,401 @@ class Server(object):
 
     def StopServer(self):
         if self.server_thread:
-            self.server_thread.stop()
+            self.running = False
+            self._wakeup()
             self.server_thread = None
 
-    def _run(self, port=10000):
-        """Start TCP server to answer basic grammar:
+    def _wakeup(self):
+        if self.wakeup:
+            try:
+                self.wakeup.send('x')
+            except socket.error:
+                pass
+
+    def RunDaemon(self, root, idle_timeout=300):
+        """Serves root on its Unix domain socket, shared by every Vim working
+        on it, until no client was attached for idle_timeout seconds. Returns
+        False if another daemon already serves root."""
+        lock = daemon.acquire_lock(root)
+        if lock is None:
+            self.logger.info('%s is already served', root)
+            return False
+        path = daemon.socket_path(root)
+        try:
+            # Left behind by a daemon which did not exit cleanly
+            if os.path.exists(path):
+                os.unlink(path)
+            self.idle_timeout = idle_timeout
+            self._run(path=path)
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+            if self.indexer.watcher:
+                self.indexer.watcher.Stop()
+            os.close(lock)
+        return True
+
+    def _run(self, port=10000, path=None):
+        """Start TCP server, or Unix domain socket server listening at path,
+        to answer basic grammar:
             DECL <name> returns location of function/type declaration
             IMPL <name> returns locatino of function/type implementation
             CALLS <name> returns list of locations of usage of function/type
-            INDEX <path> indexes C/C++ files under given path
-            AUTO <prefix> returns list of function/type starting with prefix."""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        server_address = ('localhost', int(port))
-        self.logger.info('Starting up on port %d', int(port))
-        sock.bind(server_address)
+            CALLERS <name> [depth] returns the functions calling name, then
+            the ones calling those up to depth, one per line as
+            <depth> <function> <file>:<line>:<column>, depth first
+            CALLEES <name> [depth] same for the functions called by name
+            AUTO, FIND, CALLS, CALLERS and CALLEES also take LIMIT <count>
+            and OFFSET <count> after the name to answer a page of count
+            results, followed by NEXT <offset> when there are more
+            INDEX <path> indexes C/C++ files under given path, superseding
+            the indexing in progress if any, unless it is of that same path
+            AUTO <prefix> [limit] returns sorted list of function/type starting
+            with prefix, at most limit of them
+            FIND <pattern> [limit] returns function/type containing pattern
+            or matching it fuzzily, best matches first, at most limit of them
+            QUEUE returns number of changed files waiting to be reindexed.
+            PROGRESS returns the number of files indexed and to index as a
+            JSON object, or nothing when not indexing.
+            STATS returns a JSON object of indexing counters, timers and
+            command latencies.
+            ATTACH keeps a daemon running as long as the connection is
+            open, DETACH lets it go. Both return the number of attached
+            connections.
+        Lines starting with { are JSON requests which can batch several
+        of those commands, see _handle_json. Those also accept
+            BUFFER <path> with a content field to index an unsaved buffer,
+            answering INDEXED, or QUEUED while the index is being changed
+            INDEX <path> with a priority field listing the files to index
+            first, such as the ones open in Vim
+        and take the depth of CALLERS and CALLEES in a depth field."""
+        if path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.logger.info('Starting up on %s', path)
+            sock.bind(path)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            server_address = ('localhost', int(port))
+            self.logger.info('Starting up on port %d', int(port))
+            sock.bind(server_address)
         # Listen for incoming connections
-        sock.listen(1)
-        running = True
-        while running:
-            # Wait for a connection
-            self.logger.debug('Waiting for a connection')
-            connection, client_address = sock.accept()
+        sock.listen(64)
+
+        # Idle connections are watched here while a pool of threads handles
+        # the ones with pending requests, then hands them back through the
+        # wakeup socket.
+        waker, self.wakeup = socket.socketpair()
+        tasks = queue.Queue()
+        workers = []
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._worker, args=(tasks,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        idle = set()
+        # Wake up from time to time to see whether the daemon is still needed
+        timeout = 1.0 if self.idle_timeout else None
+        self.running = True
+        while self.running:
+            readable, _, _ = select.select([sock, waker] + list(idle), [], [],
+                                           timeout)
+            if self.idle_timeout and self._idle():
+                self.logger.info('No client for %d seconds', self.idle_timeout)
+                self.running = False
+            for ready in readable:
+                if ready is sock:
+                    connection, client_address = sock.accept()
+                    if not path:
+                        # Replies are made of small writes, do not let them
+                        # wait for the acknowledgement of the previous one
+                        connection.setsockopt(
+                            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.logger.debug('Connection from %s', client_address)
+                    idle.add(Client(connection, client_address))
+                elif ready is waker:
+                    waker.recv(4096)
+                    with self.returned_lock:
+                        idle.update(self.returned)
+                        self.returned = []
+                else:
+                    idle.discard(ready)
+                    tasks.put(ready)
+
+        for worker in workers:
+            tasks.put(None)
+        for client in idle:
+            client.connection.close()
+        sock.close()
+        waker.close()
+        self.wakeup.close()
+        self.wakeup = None
+        self.logger.info('Server exiting')
+
+    def _worker(self, tasks):
+        while True:
+            client = tasks.get()
+            if client is None:
+                return
             try:
-                self.logger.debug('Connection from %s', client_address)
-                # Receive the data in small chunks and retransmit it
-                while True:
-                    data = connection.recv(2048)
-                    self.logger.debug('Received "%s"', data.rstrip())
-                    if data:
-                        if data.startswith('QUIT'):
-                            self.logger.info("Requested to quit")
-                            connection.sendall("DONE\n")
-                            running = False
-                            break
-                        elif data.startswith('INDEX'):
-                            lookup = data[6:].rstrip()
-                            if not self.index_thread:
-                                self.index_thread = threading.Thread(
-                                    target=self.indexer.IndexDirectory, args=(lookup,))
-                                self.index_thread.start()
-                                connection.sendall("INDEXING\n")
-                            else:
-                                connection.sendall("BUSY\n")
-                        elif data.startswith('AUTO'):
-                            lookup = data[5:].rstrip()
-                            matches = self.indexer.Autocomplete(lookup)
-                            for match in matches:
-                                connection.sendall("%s\n" % match)
-                        elif data.startswith('IMPL'):
-                            lookup = data[5:].rstrip()
-                            impl = self.indexer.Implementation(lookup)
-                            if impl:
-                                connection.sendall("%s:%d:%d\n" % (
-                                    impl['file'], impl['line'], impl['column']))
-                        elif data.startswith('DECL'):
-                            lookup = data[5:].rstrip()
-                            decl = self.indexer.Declaration(lookup)
-                            if decl:
-                                connection.sendall("%s:%d:%d\n" % (
-                                    decl['file'], decl['line'], decl['column']))
-                        elif data.startswith('CALLS'):
-                            lookup = data[6:].rstrip()
-                            calls = self.indexer.Calls(lookup)
-                            if (calls and len(calls) > 0):
-                                for call in calls:
-                                    connection.sendall("%s:%d:%d:%s\n" % (
-                                        call['file'], call['line'], call['column'], call['content']))
-
-                        # If we got that far, it means we did not find an
-                        # answer
-                        connection.sendall("DONE\n")
+                data = client.connection.recv(4096)
+            except socket.error:
+                data = None
+            if not data:
+                self.logger.debug('No more data from %s', client.address)
+                self._disconnect(client)
+                continue
+            client.buffer += data
+            try:
+                while '\n' in client.buffer:
+                    line, client.buffer = client.buffer.split('\n', 1)
+                    self._handle(line, client)
+            except socket.error as er:
+                self.logger.debug('Lost connection from %s: %s',
+                                  client.address, er)
+                self._disconnect(client)
+                continue
+            except Exception:
+                self.logger.exception('Failed to handle "%s"', line)
+                self._disconnect(client)
+                continue
+            with self.returned_lock:
+                self.returned.append(client)
+            self._wakeup()
+
+    def _disconnect(self, client):
+        client.connection.close()
+        self._attach(client, False)
+
+    def _attach(self, client, attached):
+        """Returns the number of attached clients once client is attached
+        or not."""
+        with self.attached_lock:
+            if attached != client.attached:
+                client.attached = attached
+                self.attached += 1 if attached else -1
+                self.last_activity = time.time()
+            return self.attached
 
+    def _idle(self):
+        with self.attached_lock:
+            return (not self.attached and
+                    time.time() - self.last_activity > self.idle_timeout)
+
+    def _handle(self, data, client):
+        self.logger.debug('Received "%s"', data.rstrip())
+        self.last_activity = time.time()
+        connection = client.connection
+        if data.startswith('{'):
+            self._handle_json(data, connection)
+            return
+        t0 = time.time()
+        args = data.split(None, 1)
+        cmd = args[0] if args else ''
+        lookup = args[1].rstrip() if len(args) > 1 else ''
+        limit = None
+        offset = 0
+        depth = None
+        paged = False
+        if cmd in PAGED:
+            args = lookup.split()
+            lookup = args[0] if args else ''
+            options = args[1:]
+            while options:
+                option = options.pop(0)
+                if (option in ('LIMIT', 'OFFSET') and options and
+                        options[0].isdigit()):
+                    paged = True
+                    if option == 'LIMIT':
+                        limit = int(options.pop(0))
                     else:
-                        self.logger.debug(
-                            'No more data from %s', client_address)
-                        break
-            finally:
-                # Clean up the connection
-                connection.close()
-        self.logger.info('Server exiting')
+                        offset = int(options.pop(0))
+                elif option.isdigit():
+                    # Depth of CALLERS and CALLEES, limit of the others
+                    if cmd == 'CALLERS' or cmd == 'CALLEES':
+                        depth = int(option)
+                    else:
+                        limit = int(option)
+        next_offset = None
+        if cmd == 'ATTACH' or cmd == 'DETACH':
+            results = [self._attach(client, cmd == 'ATTACH')]
+        else:
+            results, next_offset = self._page(cmd, lookup, limit, offset,
+                                              depth=depth)
+        writer = ReplyWriter(connection)
+        for result in results:
+            if isinstance(result, dict):
+                writer.Write(self._encode(result))
+            elif not isinstance(result, Location):
+                writer.Write("%s\n" % result)
+            elif cmd == 'CALLS':
+                writer.Write("%s:%d:%d:%s\n" % (
+                    result.file, result.line, result.column, result.content))
+            else:
+                writer.Write("%s:%d:%d\n" % (
+                    result.file, result.line, result.column))
+        # Only told to clients asking for pages
+        if paged and next_offset is not None:
+            writer.Write("NEXT %d\n" % next_offset)
+
+        # If we got that far, it means we did not find an
+        # answer
+        writer.Write("DONE\n")
+        writer.Flush()
+        self._account(cmd, t0)
+
+    def _account(self, cmd, t0):
+        self.stats.Add(cmd if cmd in COMMANDS else 'OTHER', time.time() - t0)
+
+    def _handle_json(self, data, connection):
+        """Version 2 of the protocol, one JSON object per line:
+            {"v": 2, "id": 1, "queries": [{"cmd": "IMPL", "arg": "main"},
+                                          {"cmd": "AUTO", "arg": "ma", "limit": 10}]}
+        is answered by one line per query, streamed as soon as it is ready,
+            {"id": 1, "seq": 0, "cmd": "IMPL", "results": [{"file": ..., "line": ..., "column": ...}]}
+        with a "progress": {"done": ..., "total": ...} field when a directory
+        is being indexed and the results may be partial, and a "next" field,
+        the offset of the next page, when a query with "limit" and "offset"
+        fields has more results. Those are followed by
+            {"id": 1, "done": true}
+        or by {"id": 1, "error": "..."} if the request could not be handled."""
+        request_id = None
+        try:
+            request = json.loads(data)
+            request_id = request.get('id')
+            if request.get('v') != PROTOCOL_VERSION:
+                raise ValueError('Unsupported protocol version %s' %
+                                 request.get('v'))
+            queries = request['queries']
+        except (ValueError, KeyError, TypeError, AttributeError) as er:
+            connection.sendall(self._encode({'id': request_id, 'error': str(er)}))
+            return
+        for seq, query in enumerate(queries):
+            t0 = time.time()
+            cmd = str(query.get('cmd', ''))
+            limit = self._number(query.get('limit'))
+            offset = self._number(query.get('offset')) or 0
+            depth = self._number(query.get('depth'))
+            priority = query.get('priority')
+            if not isinstance(priority, list):
+                priority = None
+            results, next_offset = self._page(
+                cmd, query.get('arg', ''), limit, offset, query.get('content'),
+                priority, depth)
+            results = [result.ToDict()
+                       if isinstance(result, (Location, CallEntry)) else result
+                       for result in results]
+            reply = {'id': request_id, 'seq': seq, 'cmd': cmd, 'results': results}
+            if next_offset is not None:
+                reply['next'] = next_offset
+            if cmd in LOOKUPS:
+                progress = self.indexer.Progress()
+                if progress:
+                    reply['progress'] = progress
+            connection.sendall(self._encode(reply))
+            self._account(cmd, t0)
+        connection.sendall(self._encode({'id': request_id, 'done': True}))
+
+    @staticmethod
+    def _number(value):
+        """Numbers sent by Vim through vim.eval() are strings."""
+        if isinstance(value, int):
+            return value
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _encode(obj):
+        try:
+            return json.dumps(obj, separators=(',', ':')) + "\n"
+        except UnicodeDecodeError:
+            # Source lines which are not valid utf-8
+            return json.dumps(obj, separators=(',', ':'),
+                              encoding='latin-1') + "\n"
+
+    def _page(self, cmd, lookup, limit=None, offset=0, content=None,
+              priority=None, depth=None):
+        """Answers a single command, returns its results along with the
+        offset of the next page, or None when limit results or less are
+        left."""
+        if not limit or cmd not in PAGED:
+            return self._query(cmd, lookup, limit, content, priority, depth,
+                               offset), None
+        # One more tells whether there is a next page
+        results = self._query(cmd, lookup, limit + 1, content, priority, depth,
+                              offset)
+        if len(results) > limit:
+            return results[:limit], offset + limit
+        return results, None
+
+    def _query(self, cmd, lookup, limit=None, content=None, priority=None,
+               depth=None, offset=0):
+        """Answers a single command with a list of names, statuses,
+        locations or call hierarchy entries, up to limit of them after the
+        first offset ones for the PAGED commands."""
+        if cmd == 'QUIT':
+            self.logger.info("Requested to quit")
+            self.running = False
+            self._wakeup()
+        elif cmd == 'INDEX':
+            if self.indexer.Indexing(lookup):
+                # Every Vim attaching to a daemon asks for its root, restarting
+                # the pass would throw away what it did so far
+                return ['INDEXING']
+            # Whatever is being indexed stops, the new pass takes over as soon
+            # as it did
+            self.indexer.Supersede()
+            self.index_thread = threading.Thread(
+                target=self.indexer.IndexDirectory, args=(lookup, priority))
+            self.index_thread.daemon = True
+            self.index_thread.start()
+            return ['INDEXING']
+        elif cmd == 'BUFFER':
+            # Only available through JSON requests which can carry the
+            # content of the buffer
+            if content is not None:
+                indexed = self.indexer.IndexBuffer(lookup, content)
+                if indexed:
+                    return ['INDEXED']
+                if indexed is None:
+                    # Indexed once the pass in progress is done
+                    return ['QUEUED']
+        elif cmd == 'AUTO':
+            return self.indexer.Autocomplete(lookup, limit, offset)
+        elif cmd == 'FIND':
+            return self.indexer.Find(lookup, limit, offset)
+        elif cmd == 'QUEUE':
+            return [self.indexer.QueueDepth()]
+        elif cmd == 'PROGRESS':
+            progress = self.indexer.Progress()
+            if progress:
+                return [progress]
+        elif cmd == 'STATS':
+            stats = self.indexer.Stats()
+            stats['commands'] = self.stats.ToDict()
+            return [stats]
+        elif cmd == 'IMPL':
+            impl = self.indexer.Implementation(lookup)
+            if impl:
+                return [impl]
+        elif cmd == 'DECL':
+            decl = self.indexer.Declaration(lookup)
+            if decl:
+                return [decl]
+        elif cmd == 'CALLS':
+            calls = self.indexer.Calls(lookup, limit, offset)
+            if calls:
+                return calls
+        elif cmd == 'CALLERS' or cmd == 'CALLEES':
+            depth = min(max(depth or 1, 1), MAX_CALL_DEPTH)
+            if cmd == 'CALLERS':
+                return self.indexer.Callers(lookup, depth, limit, offset)
+            return self.indexer.Callees(lookup, depth, limit, offset)
+        return []
 
 
 def main():
@@ -147,6 +541,40 @@ def main():
                         help='Listening port.')
     parser.add_argument('--index',
                         help='Index file.')
+    parser.add_argument('--jobs',
+                        default=1,
+                        type=int,
+                        help='Number of indexing processes, 0 for one per core.')
+    parser.add_argument('--cache',
+                        help='Directory where to keep the index cache.')
+    parser.add_argument('--include',
+                        default=[],
+                        action='append',
+                        help='Only index files matching this glob, can be '
+                        'repeated.')
+    parser.add_argument('--exclude',
+                        default=[],
+                        action='append',
+                        help='Do not index files or directories matching this '
+                        'glob, can be repeated.')
+    parser.add_argument('--threads',
+                        default=8,
+                        type=int,
+                        help='Number of threads answering queries.')
+    parser.add_argument('--daemon',
+                        metavar='ROOT',
+                        help='Serve ROOT on a Unix domain socket shared by '
+                        'every Vim working on it, in the background.')
+    parser.add_argument('--idle_timeout',
+                        default=300,
+                        type=int,
+                        help='Seconds a daemon stays around without any '
+                        'client.')
+    parser.add_argument('--debug',
+                        default=False,
+                        help='Log every command, a daemon only logs them '
+                        'with this option.',
+                        action='store_true')
     parser.add_argument('--no_server',
                         default=False,
                         help='Do not start server.',
@@ -155,15 +583,26 @@ def main():
     args, unknown_args = parser.parse_known_args()
     argv = [sys.argv[0]] + unknown_args
 
-    server = Server(args.index)
+    if args.daemon:
+        # Before any thread is started
+        daemon.detach()
+
+    # A daemon outlives the Vim which started it, its log would keep growing
+    log_file = False if args.daemon and not args.debug else None
+    server = Server(args.index, log_file=log_file, jobs=args.jobs,
+                    cache_dir=args.cache, threads=args.threads,
+                    include=args.include, exclude=args.exclude)
     if len(argv) > 1:
         if os.path.isdir(argv[1]):
-            sources = server.indexer.find_source_files(argv[1])
-            server.indexer.Index(sources, argv[1])
+            server.indexer.IndexDirectory(argv[1])
         else:
             server.indexer.Index([argv[1]], os.path.dirname(argv[1]))
 
-    if not args.no_server:
+    if args.daemon:
+        if not server.RunDaemon(os.path.abspath(args.daemon),
+                                args.idle_timeout):
+            return 1
+    elif not args.no_server:
         server._run(args.port)
 
     return 0
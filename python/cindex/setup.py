@@ -1,9 +1,11 @@
+from cindex import daemon
 from cindex.server import Server
 import os
 
 DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
 
-def SetupCIndex(debug = 0):
+def SetupCIndex(debug = 0, jobs = 0, cache_dir = None, include = (),
+                exclude = ()):
     log_file = False
     if int(debug) == 1:
         log_dir = os.path.join(DIR_OF_CURRENT_SCRIPT, "..", "..", "logs")
@@ -11,4 +13,27 @@ def SetupCIndex(debug = 0):
             os.mkdir(log_dir)
         instance = os.getpid()
         log_file = os.path.join(log_dir, "server-%d.log" % instance)
-    return Server(log_file = log_file)
+    return Server(log_file = log_file, jobs = int(jobs),
+                  cache_dir = cache_dir or None, include = include,
+                  exclude = exclude)
+
+def StartDaemon(root, jobs = 0, cache_dir = None, include = (), exclude = (),
+                debug = 0):
+    """Returns the socket of the daemon serving root, started with the given
+    options if there is none yet, or None if daemons are not available. The
+    daemon logs every command to daemon.log_path(root) in debug mode."""
+    if not daemon.available():
+        return None
+    path = daemon.find_daemon(root)
+    if path:
+        return path
+    args = ['--jobs', str(int(jobs))]
+    if cache_dir:
+        args += ['--cache', cache_dir]
+    for glob in include:
+        args += ['--include', glob]
+    for glob in exclude:
+        args += ['--exclude', glob]
+    if int(debug) == 1:
+        args.append('--debug')
+    return daemon.spawn(root, args)
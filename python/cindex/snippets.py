@@ -0,0 +1,99 @@
+import array
+import collections
+import mmap
+import os
+import threading
+
+
+class SnippetCache(object):
+    """Source lines of calls and references, read when a reply needs them.
+
+    Files are memory mapped along with a table of the offset of each line.
+    The max_files most recently used ones are kept and a file is mapped again
+    once its mtime or size changed. Unsaved buffers indexed from Vim take
+    precedence over the file on disk until the file is indexed again."""
+
+    def __init__(self, max_files=64):
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        # path -> (mtime, size, mmap, line offsets)
+        self.files = collections.OrderedDict()
+        # path -> list of lines
+        self.buffers = {}
+
+    def _open(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._close(path)
+            return None
+        entry = self.files.pop(path, None)
+        if entry and (entry[0], entry[1]) != (st.st_mtime, st.st_size):
+            entry[2].close()
+            entry = None
+        if entry is None:
+            if st.st_size == 0:
+                return None
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offsets = array.array('l', [0])
+            idx = data.find(b'\n')
+            while idx >= 0:
+                offsets.append(idx + 1)
+                idx = data.find(b'\n', idx + 1)
+            entry = (st.st_mtime, st.st_size, data, offsets)
+        self.files[path] = entry
+        while len(self.files) > self.max_files:
+            _, old = self.files.popitem(last=False)
+            old[2].close()
+        return entry
+
+    def _close(self, path):
+        entry = self.files.pop(path, None)
+        if entry:
+            entry[2].close()
+
+    def Lines(self, path, lines):
+        """Returns a dict of line number -> text for the given line numbers
+        of path, 1 based."""
+        with self.lock:
+            buf = self.buffers.get(path)
+            if buf is not None:
+                return dict((line, buf[line - 1] if 0 < line <= len(buf) else '')
+                            for line in lines)
+            entry = self._open(path)
+            if entry is None:
+                return dict((line, '') for line in lines)
+            data, offsets = entry[2], entry[3]
+            texts = {}
+            for line in lines:
+                if 0 < line <= len(offsets):
+                    start = offsets[line - 1]
+                    end = offsets[line] if line < len(offsets) else len(data)
+                    text = data[start:end].rstrip()
+                    if not isinstance(text, str):
+                        text = text.decode('utf-8', 'replace')
+                    texts[line] = text
+                else:
+                    texts[line] = ''
+            return texts
+
+    def Fill(self, locations):
+        """Sets the content of a list of Location."""
+        per_file = collections.defaultdict(list)
+        for location in locations:
+            per_file[location.file].append(location)
+        for path, file_locations in per_file.items():
+            texts = self.Lines(path, set(l.line for l in file_locations))
+            for location in file_locations:
+                location.content = texts[location.line]
+        return locations
+
+    def SetBuffer(self, path, content):
+        with self.lock:
+            self.buffers[path] = [line.rstrip() for line in content.splitlines()]
+
+    def Invalidate(self, path):
+        with self.lock:
+            self.buffers.pop(path, None)
+            self._close(path)
@@ -0,0 +1,126 @@
+import heapq
+import threading
+
+
+class Histogram(object):
+    """Latency histogram with power of two buckets, in microseconds."""
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    # Up to 2^31 us, about 35 minutes
+    BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Add(self, seconds):
+        us = int(seconds * 1000000)
+        self.buckets[min(self.BUCKETS - 1, us.bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def _percentile(self, fraction):
+        """Upper bound in milliseconds of the bucket holding the given
+        fraction of the samples, capped to the maximum seen."""
+        target = self.count * fraction
+        seen = 0
+        for idx, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(1 << idx, self.max * 1000000) / 1000.0
+        return self.max * 1000.0
+
+    def ToDict(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1000.0,
+            'mean_ms': self.total * 1000.0 / self.count if self.count else 0,
+            'max_ms': self.max * 1000.0,
+            'p50_ms': self._percentile(0.5),
+            'p95_ms': self._percentile(0.95),
+            'p99_ms': self._percentile(0.99),
+            # Upper bound of each non empty bucket in us -> count
+            'buckets': dict(((1 << idx), count)
+                            for idx, count in enumerate(self.buckets) if count),
+        }
+
+
+class IndexStats(object):
+    """Counters and per phase timers of the indexer, along with the files
+    which took the longest to parse.
+
+    Updates only take a lock and add numbers so they can be left on."""
+
+    def __init__(self, slowest=10):
+        self.lock = threading.Lock()
+        self.slowest_count = slowest
+        self.Reset()
+
+    def Reset(self):
+        with self.lock:
+            self.counters = {}
+            # phase -> [count, seconds]
+            self.phases = {}
+            # Min heap of (seconds, filename)
+            self.slowest = []
+
+    def Count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def Time(self, phase, seconds, count=1):
+        with self.lock:
+            entry = self.phases.get(phase)
+            if entry is None:
+                entry = self.phases[phase] = [0, 0.0]
+            entry[0] += count
+            entry[1] += seconds
+
+    def Timings(self, timings):
+        """Adds the dict of phase -> seconds filled by parse_file."""
+        for phase, seconds in timings.items():
+            if phase == 'nodes':
+                self.Count('nodes_visited', seconds)
+            else:
+                self.Time(phase, seconds)
+
+    def File(self, filename, seconds):
+        with self.lock:
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, (seconds, filename))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, filename))
+
+    def ToDict(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'phases': dict((phase, {'count': count, 'total_ms': seconds * 1000.0})
+                               for phase, (count, seconds) in self.phases.items()),
+                'slowest': [{'file': filename, 'ms': seconds * 1000.0}
+                            for seconds, filename in sorted(self.slowest, reverse=True)],
+            }
+
+
+class CommandStats(object):
+    """Latency histogram of each command answered by the server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def Add(self, cmd, seconds):
+        with self.lock:
+            histogram = self.histograms.get(cmd)
+            if histogram is None:
+                histogram = self.histograms[cmd] = Histogram()
+            histogram.Add(seconds)
+
+    def ToDict(self):
+        with self.lock:
+            return dict((cmd, histogram.ToDict())
+                        for cmd, histogram in self.histograms.items())
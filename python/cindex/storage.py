@@ -0,0 +1,397 @@
+import array
+
+from cindex.prefix import PrefixIndex
+from cindex.trigram import TrigramIndex
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+
+def _intern(name):
+    return intern(name) if isinstance(name, str) else name
+
+
+def group_records(records):
+    """Returns the (kind, name, line, column, caller) records of a file as
+    rows grouped the way SymbolStore keeps them:
+        (calls, refs, definitions, made)
+    calls and refs map the name of a function, or a type, to the flat list of
+    the line, column pairs of its uses, definitions is the list of (kind,
+    name, line, column) of the DECL, IMPL and TYPE records and made the list
+    of (caller, callees) of the functions making calls.
+
+    Names are interned, marshal keeps them so when the rows are loaded
+    back."""
+    calls = {}
+    refs = {}
+    definitions = []
+    made = {}
+    for kind, name, line, column, caller in records:
+        if kind == 'CALL':
+            uses = calls.get(name)
+            if uses is None:
+                uses = calls[_intern(name)] = []
+            uses += (line, column)
+            if caller:
+                callees = made.get(caller)
+                if callees is None:
+                    callees = made[caller] = set()
+                callees.add(name)
+        elif kind == 'REF':
+            uses = refs.get(name)
+            if uses is None:
+                uses = refs[_intern(name)] = []
+            uses += (line, column)
+        else:
+            definitions.append((kind, _intern(name), line, column))
+    made = [(_intern(caller), [_intern(callee) for callee in callees])
+            for caller, callees in made.items()]
+    return calls, refs, definitions, made
+
+
+class Location(object):
+    """Lightweight view of a location returned by queries."""
+    __slots__ = ('file', 'line', 'column', 'content')
+
+    def __init__(self, file, line, column, content=''):
+        self.file = file
+        self.line = line
+        self.column = column
+        self.content = content
+
+    def ToDict(self):
+        return {'file': self.file, 'line': self.line, 'column': self.column,
+                'content': self.content}
+
+
+class CallEntry(object):
+    """A function of a call hierarchy, depth calls away from the function
+    queried, along with where it is implemented if known."""
+    __slots__ = ('depth', 'name', 'location')
+
+    def __init__(self, depth, name, location=None):
+        self.depth = depth
+        self.name = name
+        self.location = location
+
+    def ToDict(self):
+        entry = {'depth': self.depth, 'name': self.name}
+        if self.location:
+            entry.update(file=self.location.file, line=self.location.line,
+                         column=self.location.column)
+        return entry
+
+    def __str__(self):
+        if self.location:
+            return '%d %s %s:%d:%d' % (self.depth, self.name, self.location.file,
+                                       self.location.line, self.location.column)
+        return '%d %s' % (self.depth, self.name)
+
+
+class Symbol(object):
+    """A function or a type. decl and impl are (path id, line, column) tuples,
+    uses maps a path id to an array of line, column pairs of the calls of a
+    function or the references to a type."""
+    __slots__ = ('decl', 'impl', 'uses')
+
+    def __init__(self):
+        self.decl = None
+        self.impl = None
+        self.uses = {}
+
+    def empty(self):
+        return not (self.decl or self.impl or self.uses)
+
+
+class InternTable(object):
+    """Assigns a stable integer id to each distinct string."""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def Id(self, value):
+        idx = self.ids.get(value)
+        if idx is None:
+            idx = len(self.values)
+            value = intern(value) if isinstance(value, str) else value
+            self.ids[value] = idx
+            self.values.append(value)
+        return idx
+
+    def Get(self, value):
+        return self.ids.get(value)
+
+    def Value(self, idx):
+        return self.values[idx]
+
+
+class SymbolStore(object):
+    """Compact storage of functions and types.
+
+    File paths are kept once in an intern table, symbol names are interned,
+    and call sites are stored as arrays of integers per file. Queries return
+    Location views built on demand. Source lines of calls are not kept, they
+    are read back when needed, see SnippetCache."""
+
+    def __init__(self):
+        self.paths = InternTable()
+        self.functions = {}
+        self.types = {}
+        # Reverse index, path id -> (function names, type names, calls made,
+        # definitions) the file contributed to, calls made being a tuple of
+        # (caller, callees) and definitions the (kind, name, line, column) of
+        # its DECL, IMPL and TYPE records, kept as only one file owns the
+        # definition of a symbol
+        self.files = {}
+        # Call graph in both directions, function name -> name of the
+        # functions it calls, or is called by, -> number of files with such
+        # calls
+        self.callees = {}
+        self.callers = {}
+        # Sorted names of functions and types for completion
+        self.prefix = PrefixIndex()
+        # Substring and fuzzy search over the same names
+        self.trigrams = TrigramIndex()
+
+    def _prune(self, table, other, name, removed):
+        symbol = table.get(name)
+        if symbol is not None and symbol.empty():
+            del table[name]
+            if name not in other:
+                removed.append(name)
+
+    def Merge(self, filename, records):
+        """Replaces whatever filename contributed with the given records."""
+        self.RemoveFile(filename)
+        added = []
+        self._add(filename, group_records(records), added)
+        self._index_names(added)
+
+    def Load(self, entries):
+        """Adds a list of (filename, rows), records grouped by group_records
+        such as the ones kept by the cache, replacing whatever those files
+        contributed. Much faster than merging records, each name is looked
+        up once per file rather than once per record."""
+        added = []
+        for filename, rows in entries:
+            self.RemoveFile(filename)
+            self._add(filename, rows, added)
+        # Unless a later entry of the same file dropped them
+        self._index_names([name for name in added
+                           if name in self.functions or name in self.types])
+
+    def _index_names(self, added):
+        if added:
+            self.prefix.AddMany(added)
+            self.trigrams.AddMany(added)
+
+    def _add(self, filename, rows, added):
+        """Adds the rows of a file which is not in the store, the names new
+        to the store are appended to added."""
+        calls, refs, definitions, made = rows
+        pid = self.paths.Id(filename)
+        functions = self.functions
+        types = self.types
+        function_names = set(calls)
+        type_names = set(refs)
+        for kind, name, line, column in definitions:
+            if kind == 'TYPE':
+                type_names.add(name)
+            else:
+                function_names.add(name)
+        function_names = tuple(function_names)
+        type_names = tuple(type_names)
+        for table, names, uses in ((functions, function_names, calls),
+                                   (types, type_names, refs)):
+            for name in names:
+                symbol = table.get(name)
+                if symbol is None:
+                    symbol = table[name] = Symbol()
+                    added.append(name)
+                pairs = uses.get(name)
+                if pairs:
+                    symbol.uses[pid] = array.array('i', pairs)
+        # In the order of the records, the last one wins
+        for kind, name, line, column in definitions:
+            if kind == 'IMPL':
+                functions[name].impl = (pid, line, column)
+            elif kind == 'DECL':
+                functions[name].decl = (pid, line, column)
+            else:
+                types[name].decl = (pid, line, column)
+        made = tuple((caller, tuple(callees)) for caller, callees in made)
+        self.files[pid] = (function_names, type_names, made,
+                           tuple(definitions))
+        self._link(made, 1)
+
+    def _link(self, made, delta):
+        """Adds the calls made by a file, a list of (caller, callees), to the
+        call graph or, with a negative delta, removes them."""
+        callees_of = self.callees
+        callers_of = self.callers
+        for caller, callees in made:
+            targets = callees_of.get(caller)
+            if targets is None:
+                if delta > 0:
+                    callees_of[caller] = dict.fromkeys(callees, delta)
+            else:
+                for callee in callees:
+                    count = targets.get(callee, 0) + delta
+                    if count > 0:
+                        targets[callee] = count
+                    else:
+                        targets.pop(callee, None)
+                if not targets:
+                    del callees_of[caller]
+            for callee in callees:
+                sources = callers_of.get(callee)
+                if sources is None:
+                    if delta > 0:
+                        callers_of[callee] = {caller: delta}
+                    continue
+                count = sources.get(caller, 0) + delta
+                if count > 0:
+                    sources[caller] = count
+                else:
+                    sources.pop(caller, None)
+                    if not sources:
+                        del callers_of[callee]
+
+    def RemoveFile(self, filename):
+        """Forgets what filename contributed, in time proportional to the
+        number of symbols it contributed to."""
+        pid = self.paths.Get(filename)
+        if pid is None:
+            return False
+        entry = self.files.pop(pid, None)
+        if entry is None:
+            return False
+        function_names, type_names, made = entry[:3]
+        self._link(made, -1)
+        # Names gone from the store, removed from the search indexes at once
+        removed = []
+        for table, other, names in ((self.functions, self.types, function_names),
+                                    (self.types, self.functions, type_names)):
+            for name in names:
+                symbol = table.get(name)
+                if symbol is None:
+                    continue
+                if symbol.decl and symbol.decl[0] == pid:
+                    symbol.decl = None
+                if symbol.impl and symbol.impl[0] == pid:
+                    symbol.impl = None
+                symbol.uses.pop(pid, None)
+                self._prune(table, other, name, removed)
+        if removed:
+            self.prefix.RemoveMany(removed)
+            self.trigrams.RemoveMany(removed)
+        return True
+
+    def Files(self):
+        return [self.paths.Value(pid) for pid in self.files]
+
+    def HasFile(self, filename):
+        pid = self.paths.Get(filename)
+        return pid is not None and pid in self.files
+
+    def Records(self, filename):
+        """Rebuilds the records contributed by filename, definitions first.
+        Callers are not kept per call, CALL records come back without one."""
+        pid = self.paths.Get(filename)
+        if pid is None or pid not in self.files:
+            return []
+        function_names, type_names, made, definitions = self.files[pid]
+        records = [definition + (None,) for definition in definitions]
+        for table, names, use_kind in ((self.functions, function_names, 'CALL'),
+                                       (self.types, type_names, 'REF')):
+            for name in names:
+                uses = table[name].uses.get(pid, ())
+                for i in range(0, len(uses), 2):
+                    records.append((use_kind, name, uses[i], uses[i + 1], None))
+        return records
+
+    def _location(self, location):
+        pid, line, column = location
+        return Location(self.paths.Value(pid), line, column)
+
+    def _uses(self, symbol, offset=0, limit=None):
+        """Locations of the uses of symbol sorted by file, up to limit of
+        them after the first offset ones. Files before offset are skipped
+        as a whole."""
+        locations = []
+        for pid in sorted(symbol.uses, key=self.paths.Value):
+            uses = symbol.uses[pid]
+            count = len(uses) // 2
+            if offset >= count:
+                offset -= count
+                continue
+            path = self.paths.Value(pid)
+            for i in range(offset * 2, len(uses), 2):
+                if limit is not None and len(locations) >= limit:
+                    return locations
+                locations.append(Location(path, uses[i], uses[i + 1]))
+            offset = 0
+        return locations
+
+    def Implementation(self, name):
+        symbol = self.functions.get(name)
+        if symbol and symbol.impl:
+            return self._location(symbol.impl)
+        return None
+
+    def Declaration(self, name):
+        symbol = self.functions.get(name)
+        if symbol:
+            if symbol.decl:
+                return self._location(symbol.decl)
+            elif symbol.impl:
+                return self._location(symbol.impl)
+        else:
+            symbol = self.types.get(name)
+            if symbol and symbol.decl:
+                return self._location(symbol.decl)
+        return None
+
+    def Calls(self, name, offset=0, limit=None):
+        symbol = self.functions.get(name)
+        if symbol:
+            if symbol.impl:
+                return self._uses(symbol, offset, limit)
+        else:
+            symbol = self.types.get(name)
+            if symbol and symbol.decl:
+                return self._uses(symbol, offset, limit)
+        return None
+
+    def _hierarchy(self, graph, name, depth, limit):
+        """Returns the CallEntry of the functions up to depth edges away from
+        name in graph, depth first. Functions already listed are listed
+        again but not followed, so that cycles end."""
+        entries = []
+        seen = set([name])
+        stack = [(1, target) for target in sorted(graph.get(name, ()), reverse=True)]
+        while stack and len(entries) < limit:
+            level, current = stack.pop()
+            symbol = self.functions.get(current)
+            location = symbol and (symbol.impl or symbol.decl)
+            entries.append(CallEntry(level, current,
+                                     location and self._location(location)))
+            if current in seen or level >= depth:
+                continue
+            seen.add(current)
+            stack.extend((level + 1, target) for target in
+                         sorted(graph.get(current, ()), reverse=True))
+        return entries
+
+    def Callers(self, name, depth=1, limit=1000):
+        """Functions calling name, then the ones calling those and so on up
+        to depth, at most limit of them."""
+        return self._hierarchy(self.callers, name, depth, limit)
+
+    def Callees(self, name, depth=1, limit=1000):
+        """Functions called by name, then the ones they call and so on up to
+        depth, at most limit of them."""
+        return self._hierarchy(self.callees, name, depth, limit)
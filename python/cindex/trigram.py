@@ -0,0 +1,217 @@
+import array
+import bisect
+import heapq
+import re
+import threading
+
+# Marks the start of names so that prefixes can be looked up as substrings
+_START = '\x02'
+# Appended to names so that every character is the start of a trigram
+_PADDING = '\x01\x01'
+
+# Highest number of candidates looked at for patterns shorter than a trigram
+# and for fuzzy matches
+CANDIDATE_BUDGET = 10000
+# Upper bounds of the name lengths indexed apart, shorter names are looked at
+# first and the longer ones only when needed
+LENGTH_BOUNDS = (8, 12, 16, 20, 24, 32, 48)
+
+
+def _trigrams(text):
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+class TrigramIndex(object):
+    """Case insensitive substring and fuzzy search over symbol names.
+
+    Each name gets an integer id and every trigram of the lower case name maps
+    to the sorted array of ids of the names containing it. Arrays are kept
+    apart for each range of name lengths so that lookups can stop once they
+    have enough short names. Removed names are only flagged, they get back their id if
+    added again, and the arrays are rebuilt once they hold more removed names
+    than live ones."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # name -> id, including removed names
+        self.ids = {}
+        # id -> name, lower case name, length and whether it is live
+        self.names = []
+        self.lowered = []
+        self.lengths = array.array('H')
+        self.live = array.array('b')
+        # Trigram -> ids, for each length range
+        self.postings = [{} for _ in range(len(LENGTH_BOUNDS) + 1)]
+        # First one and two characters -> trigrams starting with them, to
+        # look up patterns shorter than a trigram
+        self.extensions = [{} for _ in self.postings]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def Add(self, name):
+        self.AddMany([name])
+
+    def AddMany(self, names):
+        with self.lock:
+            for name in names:
+                idx = self.ids.get(name)
+                if idx is None:
+                    self._insert(name)
+                    self.count += 1
+                elif not self.live[idx]:
+                    self.live[idx] = 1
+                    self.count += 1
+
+    def _insert(self, name):
+        idx = self.ids[name] = len(self.names)
+        lowered = name.lower()
+        self.names.append(name)
+        self.lowered.append(lowered)
+        self.lengths.append(min(len(name), 0xffff))
+        self.live.append(1)
+        shard = bisect.bisect_right(LENGTH_BOUNDS, len(name))
+        postings = self.postings[shard]
+        extensions = self.extensions[shard]
+        for trigram in _trigrams(_START + lowered + _PADDING):
+            posting = postings.get(trigram)
+            if posting is None:
+                posting = postings[trigram] = array.array('i')
+                extensions.setdefault(trigram[0], []).append(trigram)
+                extensions.setdefault(trigram[:2], []).append(trigram)
+            posting.append(idx)
+
+    def Remove(self, name):
+        self.RemoveMany([name])
+
+    def RemoveMany(self, names):
+        with self.lock:
+            for name in names:
+                idx = self.ids.get(name)
+                if idx is not None and self.live[idx]:
+                    self.live[idx] = 0
+                    self.count -= 1
+            removed = len(self.names) - self.count
+            if removed > 4096 and removed > self.count:
+                self._compact()
+
+    def _compact(self):
+        names = [name for idx, name in enumerate(self.names) if self.live[idx]]
+        self._reset()
+        for name in names:
+            self._insert(name)
+        self.count = len(names)
+
+    def _substring(self, pattern, shard):
+        """Ids of live names of the given length range containing pattern, a
+        leading _START matching the start of names."""
+        live = self.live
+        lowered = self.lowered
+        shard_postings = self.postings[shard]
+        if len(pattern) < 3:
+            # Every occurrence starts a trigram thanks to the padding, there
+            # can be a lot of them so only the first ones are looked at
+            ids = set()
+            for trigram in self.extensions[shard].get(pattern, ()):
+                ids.update(shard_postings[trigram])
+                if len(ids) > CANDIDATE_BUDGET:
+                    break
+            return [idx for idx in ids if live[idx]]
+        postings = []
+        for trigram in _trigrams(pattern):
+            posting = shard_postings.get(trigram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        if len(pattern) == 3:
+            return [idx for idx in postings[0] if live[idx]]
+        candidates = set(postings[0])
+        for posting in postings[1:3]:
+            # Not worth it when checking the remaining candidates is cheaper
+            # than going through the posting
+            if len(candidates) < 64 or len(posting) > 4 * len(candidates):
+                break
+            candidates.intersection_update(posting)
+        if pattern.startswith(_START):
+            pattern = pattern[1:]
+            return [idx for idx in candidates
+                    if live[idx] and lowered[idx].startswith(pattern)]
+        return [idx for idx in candidates if live[idx] and pattern in lowered[idx]]
+
+    def _fuzzy(self, pattern, exclude):
+        """Ids and match spans of live names containing the characters of
+        pattern in order, among those sharing a trigram with it or starting
+        with the same character."""
+        # Leftmost match of each character in turn, without backtracking
+        regex = re.compile(re.escape(pattern[0]) + ''.join(
+            '[^%s]*%s' % (re.escape(c), re.escape(c)) for c in pattern[1:]))
+        trigrams = _trigrams(pattern)
+        postings = []
+        # Shorter names first, they make for tighter matches
+        for shard_postings, extensions in zip(self.postings, self.extensions):
+            shard = [shard_postings[trigram] for trigram in trigrams
+                     if trigram in shard_postings]
+            shard.sort(key=len)
+            # Abbreviations such as hshmp for hash_map share no trigram
+            shard.extend(shard_postings[trigram] for trigram in
+                         extensions.get(_START + pattern[0], ()))
+            postings.extend(shard)
+        candidates = set()
+        for posting in postings:
+            room = CANDIDATE_BUDGET - len(candidates)
+            if room <= 0:
+                break
+            candidates.update(posting[:room])
+        candidates.difference_update(exclude)
+        matches = []
+        live = self.live
+        lowered = self.lowered
+        for idx in candidates:
+            if live[idx]:
+                match = regex.search(lowered[idx])
+                if match:
+                    matches.append((match.end() - match.start(), match.start(),
+                                    len(lowered[idx]), idx))
+        return matches
+
+    def Find(self, pattern, limit=50):
+        """Returns up to limit names containing pattern: names starting with
+        it first, then names with a word starting with it, then the others,
+        shortest first. Those are followed, when pattern is at least a trigram
+        long, by names matching it fuzzily, tightest matches first."""
+        pattern = pattern.lower()
+        if not pattern:
+            return []
+        with self.lock:
+            names = self.names
+            lengths = self.lengths
+            results = []
+            seen = set()
+            # Later stages and longer names are only looked up when earlier
+            # ones did not provide enough names, they are the most expensive
+            for stage in (_START + pattern, '_' + pattern, pattern):
+                for shard in range(len(self.postings)):
+                    ids = [idx for idx in self._substring(stage, shard)
+                           if idx not in seen]
+                    seen.update(ids)
+                    ranked = heapq.nsmallest(limit - len(results), ids,
+                                             key=lengths.__getitem__)
+                    if ranked:
+                        # Names as long as the last one picked are ordered too
+                        longest = lengths[ranked[-1]]
+                        ranked = sorted(names[idx] for idx in ids
+                                        if lengths[idx] <= longest)
+                        ranked.sort(key=len)
+                        results.extend(ranked[:limit - len(results)])
+                    if len(results) >= limit:
+                        return results
+            if len(pattern) >= 3:
+                matches = heapq.nsmallest(limit - len(results),
+                                          self._fuzzy(pattern, seen))
+                results.extend(names[idx] for _, _, _, idx in matches)
+            return results
@@ -0,0 +1,86 @@
+import collections
+import ctypes
+
+import clang.cindex
+
+# Assumed size of a translation unit when libclang cannot tell
+DEFAULT_UNIT_MEMORY = 16 * 1024 * 1024
+
+
+class _ResourceUsageEntry(ctypes.Structure):
+    _fields_ = [('kind', ctypes.c_int), ('amount', ctypes.c_ulong)]
+
+
+class _ResourceUsage(ctypes.Structure):
+    _fields_ = [('data', ctypes.c_void_p), ('numEntries', ctypes.c_uint),
+                ('entries', ctypes.POINTER(_ResourceUsageEntry))]
+
+
+def unit_memory(tu):
+    """Bytes used by a translation unit as reported by libclang."""
+    try:
+        lib = clang.cindex.conf.lib
+        get_usage = lib.clang_getCXTUResourceUsage
+        dispose_usage = lib.clang_disposeCXTUResourceUsage
+    except AttributeError:
+        return DEFAULT_UNIT_MEMORY
+    get_usage.argtypes = [clang.cindex.TranslationUnit]
+    get_usage.restype = _ResourceUsage
+    dispose_usage.argtypes = [_ResourceUsage]
+    dispose_usage.restype = None
+    usage = get_usage(tu)
+    try:
+        return sum(usage.entries[i].amount for i in range(usage.numEntries))
+    finally:
+        dispose_usage(usage)
+
+
+class TranslationUnitCache(object):
+    """Least recently used translation units kept alive so that a file indexed
+    again is reparsed reusing its precompiled preamble instead of being parsed
+    from scratch. Units are evicted once their memory goes over max_memory."""
+
+    def __init__(self, cindex, includes, max_memory, logger):
+        self.cindex = cindex
+        self.includes = includes
+        self.max_memory = max_memory
+        self.logger = logger
+        # filename -> (tu, memory)
+        self.units = collections.OrderedDict()
+        self.memory = 0
+
+    def __len__(self):
+        return len(self.units)
+
+    def Parse(self, filename, unsaved_files=None):
+        entry = self.units.pop(filename, None)
+        if entry:
+            tu, memory = entry
+            self.memory -= memory
+            self.logger.debug('Reparsing %s', filename)
+            tu.reparse(unsaved_files)
+        else:
+            tu = self.cindex.parse(
+                filename, self.includes, unsaved_files,
+                clang.cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE)
+        memory = unit_memory(tu)
+        self.units[filename] = (tu, memory)
+        self.memory += memory
+        self._evict()
+        return tu
+
+    def _evict(self):
+        # Always keep the last one
+        while self.memory > self.max_memory and len(self.units) > 1:
+            filename, (tu, memory) = self.units.popitem(last=False)
+            self.memory -= memory
+            self.logger.debug('Evicting %s (%d bytes)', filename, memory)
+
+    def Remove(self, filename):
+        entry = self.units.pop(filename, None)
+        if entry:
+            self.memory -= entry[1]
+
+    def Clear(self):
+        self.units.clear()
+        self.memory = 0
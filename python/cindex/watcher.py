@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from cindex.discovery import IGNORE_FILE
+
+
+class ReindexQueue(object):
+    """Single background worker reindexing files reported by the file monitor.
+
+    Events are deduplicated per path and only handed over to the indexer once
+    no new event arrived for delay seconds, so that a burst of events (a save
+    or a checkout touching many files) goes through in one pass."""
+
+    def __init__(self, indexer, logger, root, finder, delay=0.2):
+        self.indexer = indexer
+        self.logger = logger
+        self.root = root
+        # Tells which files are indexed
+        self.finder = finder
+        self.delay = delay
+        self.condition = threading.Condition()
+        # path -> True to reindex, False to remove
+        self.pending = {}
+        self.processing = 0
+        self.last_event = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _push(self, path, index):
+        if os.path.basename(path) == IGNORE_FILE:
+            self.finder.Invalidate()
+            return
+        # Files now ignored may still be indexed, removals go through
+        if index and not self.finder.Matches(self.root, path):
+            return
+        if os.path.splitext(path)[1] not in self.finder.extensions:
+            return
+        with self.condition:
+            self.pending[path] = index
+            self.last_event = time.time()
+            self.condition.notify()
+
+    def Add(self, path):
+        self._push(path, True)
+
+    def Remove(self, path):
+        self._push(path, False)
+
+    def Depth(self):
+        """Number of files waiting to be or being reindexed."""
+        with self.condition:
+            return len(self.pending) + self.processing
+
+    def Stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                # Wait for things to settle down
+                while self.running:
+                    remaining = self.last_event + self.delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if not self.running:
+                    return
+                batch = self.pending
+                self.pending = {}
+                self.processing = len(batch)
+
+            try:
+                removed = [path for path, index in batch.items() if not index]
+                changed = [path for path, index in batch.items()
+                           if index and os.path.isfile(path)]
+                self.logger.debug('Reindexing %d file(s), removing %d file(s)',
+                                  len(changed), len(removed))
+                with self.indexer.Changing():
+                    if removed:
+                        self.indexer.Remove(removed)
+                    if changed:
+                        self.indexer.Index(changed)
+            except Exception:
+                self.logger.exception('Failed to reindex')
+            finally:
+                with self.condition:
+                    self.processing = 0
+
+
+class EventHandler(FileSystemEventHandler):
+
+    def __init__(self, indexer, queue, root, finder):
+        self.indexer = indexer
+        self.queue = queue
+        self.root = root
+        self.finder = finder
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.queue.Remove(event.src_path)
+        else:
+            prefix = os.path.join(event.src_path, '')
+            for filename in self.indexer.Files():
+                if filename.startswith(prefix):
+                    self.queue.Remove(filename)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.queue.Add(event.src_path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.queue.Add(event.src_path)
+        else:
+            for filename in self.finder.Find(self.root, event.src_path):
+                self.queue.Add(filename)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.queue.Remove(event.src_path)
+            self.queue.Add(event.dest_path)
+        else:
+            self.on_deleted(event)
+            for filename in self.finder.Find(self.root, event.dest_path):
+                self.queue.Add(filename)
+
+
+class Watcher(object):
+    """Monitors a directory and feeds changes into a ReindexQueue."""
+
+    def __init__(self, indexer, logger, root, finder):
+        self.queue = ReindexQueue(indexer, logger, root, finder)
+        self.observer = Observer()
+        self.observer.schedule(EventHandler(indexer, self.queue, root, finder),
+                               root, recursive=True)
+        self.observer.start()
+
+    def Stop(self):
+        self.observer.stop()
+        self.queue.Stop()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cindex.discovery import IgnoreRules, SourceFinder
+
+EXTENSIONS = ['.c', '.h']
+
+
+class IgnoreRulesTest(unittest.TestCase):
+
+    def test_unanchored_pattern_matches_at_any_depth(self):
+        rules = IgnoreRules(['*.o'])
+        self.assertTrue(rules.Match('a.o', False))
+        self.assertTrue(rules.Match('src/lib/a.o', False))
+        self.assertIsNone(rules.Match('a.c', False))
+
+    def test_anchored_pattern(self):
+        rules = IgnoreRules(['/build', 'doc/*.c'])
+        self.assertTrue(rules.Match('build', True))
+        self.assertIsNone(rules.Match('src/build', True))
+        self.assertTrue(rules.Match('doc/a.c', False))
+        self.assertIsNone(rules.Match('doc/sub/a.c', False))
+
+    def test_directory_only_pattern(self):
+        rules = IgnoreRules(['out/'])
+        self.assertTrue(rules.Match('out', True))
+        self.assertIsNone(rules.Match('out', False))
+
+    def test_double_star(self):
+        rules = IgnoreRules(['src/**/gen_*.c'])
+        self.assertTrue(rules.Match('src/gen_a.c', False))
+        self.assertTrue(rules.Match('src/a/b/gen_a.c', False))
+        self.assertIsNone(rules.Match('lib/gen_a.c', False))
+
+    def test_negated_pattern_wins_when_last(self):
+        rules = IgnoreRules(['*.c', '!keep.c', '# comment', ''])
+        self.assertEqual(len(rules), 2)
+        self.assertTrue(rules.Match('a.c', False))
+        self.assertFalse(rules.Match('keep.c', False))
+
+
+class SourceFinderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ['main.c', 'src/a.c', 'src/lib/b.c', 'src/lib/b.o',
+                     'test/t.c', 'build/gen.c', 'lib/src/c.h']:
+            self.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path, content=''):
+        path = os.path.join(self.root, *path.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def find(self, **kwargs):
+        for threads in (1, 4):
+            finder = SourceFinder(EXTENSIONS, threads=threads, **kwargs)
+            found = sorted(os.path.relpath(path, self.root).replace(os.sep, '/')
+                           for path in finder.Find(self.root))
+            if threads == 1:
+                serial = found
+            self.assertEqual(found, serial)
+        return found
+
+    def test_all_sources(self):
+        self.assertEqual(self.find(), [
+            'build/gen.c', 'lib/src/c.h', 'main.c', 'src/a.c', 'src/lib/b.c',
+            'test/t.c'])
+
+    def test_gitignore(self):
+        self.write('.gitignore', 'build/\n*.h\n')
+        self.write('src/.gitignore', 'lib\n')
+        self.assertEqual(self.find(), ['main.c', 'src/a.c', 'test/t.c'])
+        self.assertEqual(len(self.find(gitignore=False)), 6)
+
+    def test_exclude(self):
+        self.assertEqual(self.find(exclude=['test/', '/build']), [
+            'lib/src/c.h', 'main.c', 'src/a.c', 'src/lib/b.c'])
+
+    def test_include_files(self):
+        self.assertEqual(self.find(include=['*.h', 'main.c']),
+                         ['lib/src/c.h', 'main.c'])
+
+    def test_include_directories(self):
+        expected = ['lib/src/c.h', 'src/a.c', 'src/lib/b.c']
+        self.assertEqual(self.find(include=['src/']), expected)
+        self.assertEqual(self.find(include=['src']), expected)
+        self.assertEqual(self.find(include=['/src']),
+                         ['src/a.c', 'src/lib/b.c'])
+        self.assertEqual(self.find(include=['src/', '!src/lib/']),
+                         ['lib/src/c.h', 'src/a.c'])
+
+    def test_include_and_exclude(self):
+        self.assertEqual(self.find(include=['src'], exclude=['lib/']),
+                         ['src/a.c'])
+
+    def test_matches(self):
+        finder = SourceFinder(EXTENSIONS, include=['src/'], exclude=['lib/'])
+        path = lambda name: os.path.join(self.root, *name.split('/'))
+        self.assertTrue(finder.Matches(self.root, path('src/a.c')))
+        self.assertFalse(finder.Matches(self.root, path('src/lib/b.c')))
+        self.assertFalse(finder.Matches(self.root, path('main.c')))
+        self.assertFalse(finder.Matches(self.root, path('src/lib/b.o')))
+
+
+if __name__ == '__main__':
+    unittest.main()